@@ -1,19 +1,255 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import codecs
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import csv
+import errno
+import hashlib
+import importlib
 import logging
+import mmap
 import os
 import re
+import shlex
+import socket
+import subprocess
+import sys
+import time
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, scrolledtext
+from tkinter import ttk, filedialog, messagebox, scrolledtext, simpledialog
+
+
+class OrderPlan:
+    """ Compact plan of a batch of orders. Every order is stored only
+        once as its top directory name, layout entries are joined and
+        interned once per batch and shared by all orders and roots, so
+        memory scales with the number of orders, not with the layout
+        size. Order names are unique, so they aren't interned. """
+
+    __slots__ = ('tops', 'topdirs', 'dirs', 'files')
+
+    def __init__(self, tops, topdirs, dirs=(), files=()):
+        self.tops = tuple(tops)
+        self.topdirs = tuple(topdirs)
+        self.dirs = self.compact(dirs)
+        self.files = self.compact(files)
+
+    @staticmethod
+    def compact(tree):
+        """ Joins every layout entry into a single interned relative
+            path. Entries stay one-element tuples, so they can be passed
+            to the AppModel's make_*_tree functions as they are. """
+        return tuple((sys.intern(os.path.join(*entry)),)
+                     for entry in tree)
+
+    def __len__(self):
+        return len(self.topdirs)
+
+    def __iter__(self):
+        return iter(self.topdirs)
+
+
+class SettingsStore:
+    """ Settings kept in an ini file. The file is parsed once and read
+        again only if its modification time changes. It's written only
+        if a value really changes, atomically, through a temporary file
+        renamed over the old one. """
+
+    max_recent = 10
+    recent_section = 'recent_tops'
+    top_section = 'top:'
+
+    def __init__(self, path):
+        self.path = path
+        self.config = configparser.ConfigParser(interpolation=None)
+        self.mtime = None
+        self.dirty = False
+        self.broken = False
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        """ Reads the file if it was modified since the last read.
+            Returns True if the file was read. If the file can't be
+            parsed, it's marked as broken and read again next time. """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        config = configparser.ConfigParser(interpolation=None)
+        try:
+            config.read(self.path)
+        except configparser.Error:
+            self.broken = True
+            raise
+        self.config = config
+        self.mtime = mtime
+        self.dirty = False
+        self.broken = False
+        return True
+
+    def get(self, section, key, fallback=None):
+        return self.config.get(section, key, fallback=fallback)
+
+    def items(self, section):
+        """ Returns all values of a section as a dictionary. """
+        if self.config.has_section(section):
+            return dict(self.config[section])
+        return {}
+
+    def set(self, section, key, val):
+        """ Sets a value, the store becomes dirty only if the value
+            changes. """
+        if self.get(section, key) == val:
+            return
+        if not self.config.has_section(section):
+            self.config.add_section(section)
+        self.config.set(section, key, val)
+        self.dirty = True
+
+    def recent_tops(self):
+        """ Returns recently used tops, the most recent first. """
+        recent = self.items(self.recent_section)
+        return [recent[key] for key in sorted(recent, key=int)]
+
+    def top_options(self, top):
+        """ Returns options remembered for a top. """
+        return self.items(self.top_section + top)
+
+    def remember_top(self, top, options):
+        """ Moves a top to the front of recently used tops and remembers
+            its options. Options of tops dropped from the list are
+            removed. """
+        recent = self.recent_tops()
+        tops = [top] + [t for t in recent if t != top]
+        for t in tops[self.max_recent:]:
+            self.config.remove_section(self.top_section + t)
+            self.dirty = True
+        tops = tops[:self.max_recent]
+        if tops != recent:
+            self.config.remove_section(self.recent_section)
+            for i, t in enumerate(tops):
+                self.set(self.recent_section, str(i), t)
+        self.set('user_options', 'top', top)
+        for key, val in options.items():
+            self.set(self.top_section + top, key, val)
+
+    def save(self):
+        """ Writes the file atomically if any value has changed. A file
+            which can't be parsed is never overwritten. Returns True if
+            the file was written. """
+        if not self.dirty or self.broken:
+            return False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as fw:
+                self.config.write(fw)
+                fw.flush()
+                os.fsync(fw.fileno())
+            os.replace(tmp, self.path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+        self.mtime = os.path.getmtime(self.path)
+        self.dirty = False
+        return True
+
+
+class ParsePreview:
+    """ Statistics of an input being edited: parsed order IDs, ignored
+        lines and duplicates. A result of every line is kept, so an edit
+        only parses the edited lines. A line results in its order ID,
+        in '' if it's blank or in None if it's ignored. Duplicates are
+        found case-insensitively, as in the batch validation. """
+
+    def __init__(self):
+        self.lines = ['']
+        self.counts = collections.Counter()
+        self.parsed = 0
+        self.ignored = 0
+        self.duplicates = 0
+
+    def parse_line(self, line):
+        s = AppModel.word_re.search(line)
+        if s:
+            return s.group()
+        return None if line.strip() else ''
+
+    def add(self, result):
+        if result is None:
+            self.ignored += 1
+        elif result:
+            key = result.casefold()
+            self.counts[key] += 1
+            self.parsed += 1
+            if self.counts[key] > 1:
+                self.duplicates += 1
+
+    def remove(self, result):
+        if result is None:
+            self.ignored -= 1
+        elif result:
+            key = result.casefold()
+            if self.counts[key] > 1:
+                self.duplicates -= 1
+            self.counts[key] -= 1
+            if not self.counts[key]:
+                del self.counts[key]
+            self.parsed -= 1
+
+    def replace(self, first, last, lines):
+        """ Replaces results of lines from first to last (0-based,
+            last excluded) with results of new lines. """
+        results = [self.parse_line(line) for line in lines]
+        for result in self.lines[first:last]:
+            self.remove(result)
+        for result in results:
+            self.add(result)
+        self.lines[first:last] = results
 
 
 class AppModel:
 
+    layout_marker = '.dirmaker-layout-'
+    shard_marker = '.dirmaker-shard'
+    shard_schemes = ('none', 'prefix', 'brand')
+    hook_timeout = 600
+    lock_timeout = 30
+    lock_stale = 600
+    lock_poll = 0.2
+    max_path = 259
+    reserved_names = frozenset(
+        ['CON', 'PRN', 'AUX', 'NUL'] +
+        ['COM{}'.format(i) for i in range(1, 10)] +
+        ['LPT{}'.format(i) for i in range(1, 10)])
+    line_re = re.compile('[^\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]+')
+    word_re = re.compile(r'\w+')
+
+    def split_top(self, top):
+        """ Splits a top path into a list of roots. Several roots are
+            separated by os.pathsep, blanks and repeated roots are
+            skipped. """
+        tops = []
+        for d in top.split(os.pathsep):
+            d = d.strip()
+            if d and d not in tops:
+                tops.append(d)
+        return tops
+
     def verify_top(self, top):
-        """ Checks if a given path exists and is a directory """
-        if os.path.isdir(top):
+        """ Checks if at least one root of a given path exists and is
+            a directory. Unreachable roots fail on their own when
+            orders are created. """
+        if any(os.path.isdir(d) for d in self.split_top(top)):
             return True
         return False
 
@@ -30,30 +266,461 @@ class AppModel:
             return True
         return False
 
+    def iter_dir_name(self, inp):
+        """ Yields an initial alphanumeric string (directory name) of
+            every line inserted by user. Lines are matched in place,
+            so neither a list of lines nor line copies are created. """
+        for line in self.line_re.finditer(inp):
+            s = self.word_re.search(inp, line.start(), line.end())
+            if s:
+                yield s.group()
+
     def extract_dir_name(self, inp):
         """ Constructs a list from an input list. An input list contains
             lines inserted by user. Function extracts only an initial
             alphanumeric string (directory names) and returns it in 
-            a new list. In this case such function is more readable than 
-            a list coprehension. """
-        dir_name = []
-        for i in inp.splitlines():
-            s = re.search('\w+', i)
-            if s:
-                dir_name.append(s.group())
-        return dir_name
+            a new list. """
+        return list(self.iter_dir_name(inp))
+
+    def join_brand(self, topdir, brand=None):
+        """ Adds a brand suffix preceded by the delimiter to a directory
+            name if the brand suffix is given. """
+        delimiter = '_'
+        if brand and brand != 'Empty':
+            topdir += delimiter + brand
+        return topdir
+
+    def iter_topdir(self, dir_list, brand=None):
+        """ Yields every element of input iterable with a brand suffix
+            preceded by the delimiter if the brand suffix is given. """
+        for topdir in dir_list:
+            yield self.join_brand(topdir, brand)
 
     def add_brand(self, dir_list, brand=None):
         """ Adds a brand suffix preceded by the delimiter to every
             element of input list if the brand suffix is given and
             returns a new list. """
-        delimiter = '_'
-        topdir_list = []
-        for topdir in dir_list:
-            if brand and brand != 'Empty':
-                topdir += delimiter + brand
-            topdir_list.append(topdir)
-        return topdir_list
+        return list(self.iter_topdir(dir_list, brand))
+
+    def shard_of(self, topdir, shard, brand=None):
+        """ Returns a name of a shard of an order. A shard is a tuple of
+            a scheme and a prefix width. The 'prefix' scheme takes the
+            first characters of the order's name, the 'brand' scheme
+            takes the order's brand ('Empty' if there is none). If the
+            brand isn't given, it's read from the name's suffix, which
+            is ambiguous for order IDs containing '_'. """
+        scheme, width = shard
+        if scheme == 'prefix':
+            return topdir[:width].upper()
+        if brand is None:
+            brand = topdir.rpartition('_')[2] if '_' in topdir else ''
+        if not brand or brand == 'Empty':
+            return 'Empty'
+        return brand
+
+    def shard_topdir(self, topdir, shard=None, brand=None):
+        """ Returns a path of an order relative to a root. The shard is
+            computed from the order's name and brand only, so any order
+            is found without scanning a root. """
+        if not shard or shard[0] == 'none':
+            return topdir
+        return os.path.join(self.shard_of(topdir, shard, brand), topdir)
+
+    def make_shard(self, top, head):
+        """ Creates a shard directory marked as a shard, so it's told
+            apart from orders. """
+        os.makedirs(os.path.join(top, head), exist_ok=True)
+        try:
+            open(os.path.join(top, head, self.shard_marker), 'x').close()
+        except FileExistsError:
+            pass
+
+    def make_plan(self, top, inp, brand, dirs, files, shard=None):
+        """ Creates a compact plan of a batch straight from the user's
+            input, without any intermediate lists. """
+        topdirs = (self.shard_topdir(self.join_brand(order_id, brand), shard,
+                                     brand)
+                   for order_id in self.iter_dir_name(inp))
+        return OrderPlan(self.split_top(top), topdirs, dirs, files)
+
+    def iter_mmap_lines(self, mm, encoding, size=1 << 20):
+        """ Yields lines of a memory-mapped file decoded chunk by chunk
+            with an incremental decoder, so any encoding works, also
+            those which aren't ASCII-compatible, like UTF-16. """
+        decoder = codecs.getincrementaldecoder(encoding)()
+        pending = ''
+        for start in range(0, len(mm), size):
+            pending += decoder.decode(mm[start:start + size])
+            lines = pending.split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            yield pending
+
+    def iter_csv_rows(self, path, delimiter=',', encoding='utf-8-sig'):
+        """ Yields rows of a CSV file. The file is memory-mapped and
+            decoded in chunks, so it's never loaded as a whole. """
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                lines = self.iter_mmap_lines(mm, encoding)
+                for row in csv.reader(lines, delimiter=delimiter):
+                    yield row
+
+    def find_column(self, header, column):
+        """ Returns an index of a column given by its number, counted
+            from 1 as in a spreadsheet, or by its name in a header row
+            (case-insensitive). """
+        column = column.strip()
+        if column.isdigit() and int(column) > 0:
+            return int(column) - 1
+        names = [name.strip().lower() for name in header]
+        try:
+            return names.index(column.lower())
+        except ValueError:
+            raise ValueError("Column not found: {}".format(column))
+
+    def find_brand(self, model, brands):
+        """ Returns a brand of a vehicle model, i.e. the brand of the
+            first keyword found in the model's words, or None. """
+        for word in re.findall(r'[^\W_]+', model):
+            brand = brands.get(word.lower())
+            if brand:
+                return brand
+        return None
+
+    def iter_csv_orders(self, path, id_column, model_column='',
+                        header=True, delimiter=',', encoding='utf-8-sig',
+                        brands=None):
+        """ Yields an order ID and a brand (or None) of every row of
+            a GOCAT CSV export. The brand is found in a model column
+            if it's given. Rows without any alphanumeric ID are
+            skipped. """
+        rows = self.iter_csv_rows(path, delimiter, encoding)
+        names = next(rows, []) if header else []
+        id_col = self.find_column(names, id_column)
+        model_col = None
+        if model_column.strip():
+            model_col = self.find_column(names, model_column)
+        for row in rows:
+            if id_col >= len(row):
+                continue
+            s = self.word_re.search(row[id_col])
+            if not s:
+                continue
+            brand = None
+            if model_col is not None and model_col < len(row):
+                brand = self.find_brand(row[model_col], brands or {})
+            yield s.group(), brand
+
+    def make_csv_plan(self, top, path, brand, dirs, files, shard=None,
+                      **options):
+        """ Creates a compact plan of a batch straight from a GOCAT CSV
+            export. A brand found in a row overrides a given brand. """
+        topdirs = (self.shard_topdir(self.join_brand(order_id,
+                                                     row_brand or brand),
+                                     shard, row_brand or brand)
+                   for order_id, row_brand
+                   in self.iter_csv_orders(path, **options))
+        return OrderPlan(self.split_top(top), topdirs, dirs, files)
+
+    def validate_plan(self, plan):
+        """ Checks names of all orders in a plan and returns a list of
+            all problems found, each as a tuple of an error key and its
+            arguments. Duplicates are found case-insensitively, as the
+            share is, with a hash index of the batch and a single
+            listing of every root (or of every shard used), so the check
+            is linear in the number of orders. A root which can't be
+            listed is skipped, it fails on its own when orders are
+            created. An order still lying directly in a root, not yet
+            moved into its shard, exists as well. """
+        problems = []
+        batch = {}
+        for topdir in plan.topdirs:
+            key = topdir.casefold()
+            first = batch.get(key)
+            if first is None:
+                batch[key] = topdir
+                if any(name.split('.')[0].upper() in self.reserved_names
+                       for name in os.path.split(topdir)):
+                    problems.append(('reserved', topdir))
+            elif first == topdir:
+                problems.append(('duplicate', topdir))
+            else:
+                problems.append(('collision', topdir, first))
+        longest = max([len(entry[0]) + 1
+                       for entry in plan.dirs + plan.files] or [0])
+        for top in plan.tops:
+            listings = {'': self.list_casefold(top, '')}
+            if listings[''] is None:
+                continue
+            prefix = len(os.path.join(top, ''))
+            for topdir in batch.values():
+                head, tail = os.path.split(topdir)
+                if head not in listings:
+                    listings[head] = self.list_casefold(top, head) or {}
+                name = listings[head].get(tail.casefold())
+                if name is not None and name != tail:
+                    problems.append(('existing', topdir,
+                                     os.path.join(top, head, name)))
+                name = listings[''].get(tail.casefold()) if head else None
+                if name is not None:
+                    problems.append(('existing', topdir,
+                                     os.path.join(top, name)))
+                if prefix + len(topdir) + longest > self.max_path:
+                    problems.append(('length', os.path.join(top, topdir)))
+        return problems
+
+    def list_casefold(self, top, head):
+        """ Returns entries of a root or of its shard indexed by their
+            case-folded names. A shard not created yet is empty. Returns
+            None if a directory can't be listed. """
+        path = os.path.join(top, head) if head else top
+        try:
+            return {name.casefold(): name for name in os.listdir(path)}
+        except FileNotFoundError:
+            if head:
+                return {}
+        except OSError:
+            pass
+        return None
+
+    def layout_version(self, groups):
+        """ Returns a short hash identifying a layout. """
+        return hashlib.sha1(repr(groups).encode('utf-8')).hexdigest()[:12]
+
+    def upgrade_order(self, top, topdir, groups, version, names=None):
+        """ Creates layout entries missing in an existing order. Every
+            group is a tuple of a trigger, i.e. a name the order must
+            already contain for the group to apply (or None), its
+            directories and its files. Each directory of the order is
+            listed at most once. The applied layout version is recorded
+            in a marker file, an order already marked with the version
+            is skipped after a single listing, other orders are completed
+            under their lock. Names of the order are listed unless they
+            are given. Returns True if the order was upgraded. """
+        if names is None:
+            names = set(os.listdir(os.path.join(top, topdir)))
+        marker = self.layout_marker + version
+        if marker in names:
+            return False
+        with self.lock_order(top, topdir):
+            self.complete_order(top, topdir, groups, names, marker)
+        return True
+
+    def complete_order(self, top, topdir, groups, names, marker):
+        """ Creates missing layout entries of an order listed before
+            and replaces its layout marker. """
+        path = os.path.join(top, topdir)
+        listings = {(): names}
+
+        def exists(entry):
+            parent = entry[:-1]
+            if parent not in listings:
+                try:
+                    listings[parent] = set(os.listdir(
+                        os.path.join(path, *parent)))
+                except FileNotFoundError:
+                    listings[parent] = set()
+            return entry[-1] in listings[parent]
+
+        missing_dirs = []
+        missing_files = []
+        for trigger, dirs, files in groups:
+            if trigger and trigger not in names:
+                continue
+            missing_dirs.extend(d for d in dirs if not exists(d))
+            missing_files.extend(f for f in files if not exists(f))
+        self.make_dir_tree(top, topdir, missing_dirs)
+        self.make_file_tree(top, topdir, missing_files)
+        for name in names:
+            if name.startswith(self.layout_marker):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(path, name))
+        open(os.path.join(path, marker), 'w').close()
+
+    def layout_names(self, groups):
+        """ Returns names of top-level entries of a layout. A directory
+            containing any of them is an order. """
+        return {entry[0] for trigger, dirs, files in groups
+                for entry in dirs + files}
+
+    def upgrade_top(self, top, groups, workers):
+        """ Upgrades all orders in a root in a thread pool. The root is
+            listed once, hidden entries and files are skipped. Only
+            directories containing at least one entry of the layout are
+            orders, other folders of the share are skipped. Orders of
+            shards found in the root are upgraded in a second pass.
+            Returns a result dictionary. """
+        version = self.layout_version(groups)
+        result = {'top': top, 'upgraded': 0, 'skipped': 0, 'errors': []}
+        layout_names = self.layout_names(groups)
+
+        def upgrade(topdir):
+            try:
+                names = set(os.listdir(os.path.join(top, topdir)))
+                if self.shard_marker in names:
+                    return 'shard', [os.path.join(topdir, name)
+                                     for name in names
+                                     if not name.startswith('.')]
+                if not names & layout_names:
+                    return 'skipped', None
+                if self.upgrade_order(top, topdir, groups, version,
+                                      names):
+                    return 'upgraded', None
+            except NotADirectoryError:
+                pass
+            except OSError as e:
+                return 'errors', (os.path.join(top, topdir),
+                                  e.strerror or str(e))
+            return 'skipped', None
+
+        topdirs = [name for name in os.listdir(top)
+                   if not name.startswith('.')]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as executor:
+            while topdirs:
+                shards = []
+                for key, val in executor.map(upgrade, topdirs):
+                    if key == 'shard':
+                        shards.extend(val)
+                    elif val:
+                        result[key].append(val)
+                    else:
+                        result[key] += 1
+                topdirs = shards
+        return result
+
+    def rebalance_top(self, top, shard, layout_names, workers):
+        """ Moves orders lying directly in a root into their shards in
+            a thread pool. Only directories containing at least one of
+            the layout names are orders, other folders of the share are
+            skipped. Files, hidden entries and shards are left in place.
+            Returns a result dictionary. """
+        result = {'top': top, 'moved': 0, 'skipped': 0, 'errors': []}
+
+        def move(topdir):
+            path = os.path.join(top, topdir)
+            head = self.shard_of(topdir, shard)
+            target = os.path.join(top, head, topdir)
+            try:
+                names = set(os.listdir(path))
+                if self.shard_marker in names:
+                    return None
+                if not names & layout_names:
+                    return 'skipped'
+                if head == topdir:
+                    raise FileExistsError(errno.EEXIST,
+                                          "Order is named as its shard")
+                self.make_shard(top, head)
+                with self.lock_order(top, topdir), \
+                        self.lock_order(top, os.path.join(head, topdir)):
+                    if os.path.exists(target):
+                        raise FileExistsError(errno.EEXIST,
+                                              "Order exists in its shard")
+                    os.rename(path, target)
+            except NotADirectoryError:
+                return None
+            except OSError as e:
+                return path, e.strerror or str(e)
+            return True
+
+        topdirs = [name for name in os.listdir(top)
+                   if not name.startswith('.')]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as executor:
+            for moved in executor.map(move, topdirs):
+                if moved is True:
+                    result['moved'] += 1
+                elif moved == 'skipped':
+                    result['skipped'] += 1
+                elif moved:
+                    result['errors'].append(moved)
+        return result
+
+    def load_hook(self, spec):
+        """ Returns a hook called with a list of order paths. A spec
+            'py:module:function' names a Python callable, any other spec
+            is a command, order paths are appended to its arguments.
+            On Windows the command line is kept as written, so quoted
+            paths with spaces reach the program unchanged. """
+        spec = spec.strip()
+        if spec.startswith('py:'):
+            module, _, func = spec[3:].strip().rpartition(':')
+            return getattr(importlib.import_module(module), func)
+        if not spec:
+            raise ValueError("Empty hook command")
+        if os.name == 'nt':
+            return lambda paths: self.run_command(
+                ' '.join((spec, subprocess.list2cmdline(paths))))
+        args = shlex.split(spec)
+        return lambda paths: self.run_command(args + paths)
+
+    def run_command(self, args):
+        """ Runs a command, given as a list of arguments or as a Windows
+            command line, without a console window. Raises OSError if
+            it fails, fails to start or doesn't end in time. """
+        proc = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+        try:
+            out, _ = proc.communicate(timeout=self.hook_timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise TimeoutError(errno.ETIMEDOUT, "Hook timed out",
+                               args if isinstance(args, str) else args[0])
+        if proc.returncode:
+            msg = "Exit code {}".format(proc.returncode)
+            lines = out.decode(errors='replace').strip().splitlines()
+            if lines:
+                msg = ": ".join((msg, lines[-1]))
+            raise OSError(msg)
+
+    def run_hooks(self, hooks, paths, batch_size, workers):
+        """ Runs hooks for created orders. Each hook is called for
+            batches of order paths, all batches of all hooks run in
+            a bounded thread pool. Returns a result dictionary of every
+            hook with its batch count, total running time and errors. """
+        stats = []
+        tasks = []
+        for name, spec in hooks:
+            stat = {'name': name, 'batches': 0, 'seconds': 0.0,
+                    'errors': []}
+            stats.append(stat)
+            try:
+                hook = self.load_hook(spec)
+            except Exception as e:
+                stat['errors'].append(str(e))
+                continue
+            for i in range(0, len(paths), batch_size):
+                tasks.append((stat, hook, paths[i:i + batch_size]))
+
+        def call(task):
+            stat, hook, batch = task
+            start = time.time()
+            try:
+                hook(batch)
+                error = None
+            except Exception as e:
+                error = "{} ({} orders from {})".format(e, len(batch),
+                                                         batch[0])
+            return stat, time.time() - start, error
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as executor:
+            for stat, seconds, error in executor.map(call, tasks):
+                stat['batches'] += 1
+                stat['seconds'] += seconds
+                if error:
+                    stat['errors'].append(error)
+        return stats
 
     def make_dir_tree(self, top, topdir, tree):
         """ Creates directory tree in a given path. """
@@ -62,11 +729,75 @@ class AppModel:
             os.makedirs(dpath, exist_ok=True)
 
     def make_file_tree(self, top, topdir, tree):
-        """ Creates files in a given path. """
+        """ Creates files in a given path. A file is created exclusively,
+            so an existing file is never truncated, even if another run
+            has just created it. """
         for f in tree:
             fpath = os.path.join(top, topdir, *f)
-            if not os.path.isfile(fpath):
-                open(fpath, 'w').close()
+            try:
+                open(fpath, 'x').close()
+            except FileExistsError:
+                pass
+
+    def lock_path(self, top, topdir):
+        """ Returns a path of a hidden lock file of an order, placed next
+            to the order's directory. """
+        head, tail = os.path.split(topdir)
+        return os.path.join(top, head, '.{}.lock'.format(tail))
+
+    def break_stale_lock(self, path):
+        """ Removes a lock file left by a crashed run. The lock is first
+            renamed to a name unique to this run, so only one of several
+            runs finding the same stale lock removes it. The renamed lock
+            is checked again: if another run has broken the stale lock
+            and taken a fresh one in the meantime, the fresh lock is
+            linked back, unless yet another lock has been taken. """
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            return
+        if age < self.lock_stale:
+            return
+        stale = '{}.{}-{}.stale'.format(path, socket.gethostname(),
+                                        os.getpid())
+        try:
+            os.rename(path, stale)
+            age = time.time() - os.path.getmtime(stale)
+        except FileNotFoundError:
+            return
+        if age < self.lock_stale:
+            with contextlib.suppress(FileExistsError):
+                os.link(stale, path)
+        os.remove(stale)
+
+    @contextlib.contextmanager
+    def lock_order(self, top, topdir):
+        """ Holds a lock of an order, so runs on different workstations
+            never build the same order at the same time. The lock file
+            is created atomically and names its owner. A lock older
+            than lock_stale seconds is treated as left by a crashed run
+            and broken. Raises TimeoutError if the order is still locked
+            after lock_timeout seconds. """
+        path = self.lock_path(top, topdir)
+        deadline = time.time() + self.lock_timeout
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                self.break_stale_lock(path)
+                if time.time() > deadline:
+                    raise TimeoutError(errno.ETIMEDOUT, "Order is locked",
+                                       path)
+                time.sleep(self.lock_poll)
+        try:
+            os.write(fd, '{}:{}'.format(socket.gethostname(),
+                                        os.getpid()).encode('utf-8'))
+            os.close(fd)
+            yield
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
 
 
 class AppController:
@@ -88,13 +819,53 @@ class AppController:
         self.validerr = {'top': "Invalid directory!",
                          'brand': "Brand is not selected!",
                          'inp': "Empty input!"}
+        self.batcherr = {'duplicate': "Duplicate order: {}",
+                         'collision': "{} collides with {}",
+                         'reserved': "Reserved name: {}",
+                         'existing': "{} collides with existing {}",
+                         'length': "Path too long: {}",
+                         'more': "... and {} more problems."}
+        self.max_errors = 20
+        self.max_workers = 8
+        self.shard_width = 5
+        self.hook_options = {'batch_size': 100,
+                             'workers': 4,
+                             'timeout': 600}
+        self.preview = ParsePreview()
+        self.previewmsg = "Orders: {}, ignored lines: {}, duplicates: {}"
+        self.runerr = {'root': "{} failed after {} of {} orders: {}",
+                       'import': "Import failed: {}",
+                       'notdir': "Directory not found",
+                       'locked': "{} is locked by another run, skipped.",
+                       'hook': "Hook {} failed: {}",
+                       'upgrade': "Cannot upgrade {}: {}",
+                       'rebalance': "Cannot move {}: {}",
+                       'rebalance_confirm': " ".join(
+                           """Move all orders in {} 
+                           into their shards?""".split()),
+                       'confirm': " ".join(
+                           """Create missing layout entries in all 
+                           existing orders in {}?""".split())}
+        self.csv_options = {'id_column': '1',
+                            'model_column': '',
+                            'header': 'yes',
+                            'delimiter': ',',
+                            'encoding': 'utf-8-sig'}
+        self.csv_brands = {'audi': 'Audi',
+                           'seat': 'Seat',
+                           'skoda': 'Skoda'}
         self.configerr = {'nofile': "Configuration file not found.",
                           'parse': "Configuration file parsing error.",
                           'keyerr': " ".join(
                               """Requested value not found 
                               in the configuration file. 
                               Default value is used instead: {}.
-                              """.format(self.userdir).split())}
+                              """.format(self.userdir).split()),
+                          'write': "Configuration file not saved: {}",
+                          'shard': "Unknown shard scheme: {}",
+                          'noshard': " ".join(
+                              """Sharding is not enabled 
+                              in the configuration file.""".split())}
 
     def init_model(self):
         """ Initialises the Application Model. """
@@ -117,11 +888,11 @@ class AppController:
         self.view.mainloop()
 
     def init_config(self):
-        """ Initialise a ConfigParser object, creates a config file 
+        """ Initialise a settings store, creates a config file 
             path, calls a function loading values from a config 
             file. """
-        self.config = configparser.ConfigParser()
         self.configfile = os.path.join(self.appdir, '.settings.ini')
+        self.config = SettingsStore(self.configfile)
         self.load_config()
         
     def create_appdir(self):
@@ -142,30 +913,55 @@ class AppController:
                             datefmt='%Y-%m-%d %H:%M:%S')
         self.logger = logging.getLogger(__name__)
         
-    def write_config(self, key, val):
-        """ Writes data to a config file. """
-        self.config['user_options'] = {key: val}
-        if not os.path.isdir(self.appdir):
-            os.makedirs(self.appdir, exist_ok=True)
-        with open(self.configfile, 'w+') as fw:
-            self.config.write(fw)
+    def write_config(self, order):
+        """ Remembers a top and options of an order. The config file is
+            written only if anything has changed. A failed write doesn't
+            stop a run. """
+        options = {'brand': order['brand'],
+                   'make_02': 'yes' if order['make_02'] else 'no',
+                   'make_pdf': 'yes' if order['make_pdf'] else 'no'}
+        try:
+            self.config.load()
+        except configparser.Error:
+            self.logger.warning(self.configerr['parse'])
+        self.config.remember_top(order['top'], options)
+        try:
+            self.config.save()
+        except OSError as e:
+            self.logger.warning(self.configerr['write'].format(e))
+        if self.config.broken:
+            self.logger.warning(self.configerr['write'].format(
+                self.configerr['parse']))
+        self.view.set_recent_tops(self.config.recent_tops())
 
     def load_config(self):
         """ Checks if a configuration file exists, parses and loads 
             data from it to the View. """
-        if os.path.isfile(self.configfile):
+        if self.config.exists():
             try:
-                self.config.read(self.configfile)
-            except configparser.ParsingError:
+                self.config.load()
+            except configparser.Error:
                 self.logger.warning(self.configerr['parse'])
         else:    
             self.logger.warning(self.configerr['nofile'])
-        try:
-            top = self.config['user_options']['top']
-        except KeyError:
+        top = self.config.get('user_options', 'top')
+        if top is None:
             self.logger.warning(self.configerr['keyerr'])
             top = self.userdir
         self.set_top(top)
+        self.view.set_recent_tops(self.config.recent_tops())
+        self.select_top(top)
+
+    def select_top(self, top):
+        """ Restores options remembered for a top from the settings
+            already loaded. """
+        options = self.config.top_options(top)
+        if 'brand' in options:
+            self.view.set_brand(options['brand'])
+        if 'make_02' in options:
+            self.view.set_make_02(options['make_02'] == 'yes')
+        if 'make_pdf' in options:
+            self.view.set_make_pdf(options['make_pdf'] == 'yes')
 
     def set_top(self, d):
         """ Calls View's function setting a top path. """
@@ -186,6 +982,16 @@ class AppController:
     def get_make_pdf(self):
         return self.view.get_make_pdf()
 
+    def edit_input(self, first, last, lines):
+        """ Updates the input preview with edited lines. """
+        self.preview.replace(first, last, lines)
+
+    def show_preview(self):
+        self.view.set_previewmsg(self.previewmsg.format(
+            self.preview.parsed,
+            self.preview.ignored,
+            self.preview.duplicates))
+
     def create_order_dict(self):
         """ Creates a dictionary object containing data inserted by
             an user. """
@@ -198,13 +1004,14 @@ class AppController:
             }
 
     def validate_data(self, order):
-        """ Chcecks all values inserted by an user. """
+        """ Chcecks all values inserted by an user. The input isn't
+            checked when orders are imported from a file. """
         data_tuple = [
             (self.model.verify_top(order['top']),
              self.validerr['top']),
             (self.model.verify_brand(order['brand']),
              self.validerr['brand']),
-            (self.model.verify_inp(order['inp']),
+            (order.get('csv') or self.model.verify_inp(order['inp']),
              self.validerr['inp'])]
         verified = []
         for v, msg in data_tuple:
@@ -215,35 +1022,307 @@ class AppController:
             return True
         return False
 
-    def create_dirs(self, order):
-        """ Creates a directory tree according the selected options. """
-        inp = self.model.extract_dir_name(order['inp'])
-        topdir_list = self.model.add_brand(inp,
-                                           order['brand'])
-        for topdir in topdir_list:
-            self.model.make_dir_tree(order['top'],
-                                     topdir,
-                                     self.basic_dirs)
-
-            if order['make_02']:
-                self.model.make_dir_tree(order['top'],
-                                         topdir,
-                                         self.dirs_02)
-                self.model.make_file_tree(order['top'],
-                                          topdir,
-                                          self.files_02)
-            if order['make_pdf']:
-                self.model.make_file_tree(order['top'],
-                                          topdir,
-                                          self.no_pdf)
+    def create_upgrade_groups(self):
+        """ Returns the layout applied to existing orders. Optional
+            parts are only completed in orders which already contain
+            them. """
+        return ((None, tuple(self.basic_dirs), ()),
+                (self.dirs_02[0][0], tuple(self.dirs_02),
+                 tuple(self.files_02)))
+
+    def create_layout(self, order):
+        """ Returns directories and files of a single order according
+            the selected options. """
+        dirs = list(self.basic_dirs)
+        files = []
+        if order['make_02']:
+            dirs.extend(self.dirs_02)
+            files.extend(self.files_02)
+        if order['make_pdf']:
+            files.extend(self.no_pdf)
+        return dirs, files
+
+    def validate_plan(self, plan):
+        """ Checks the whole batch before any directory is created.
+            All problems are logged, the first of them are shown to
+            an user. """
+        problems = self.model.validate_plan(plan)
+        if not problems:
+            return True
+        self.show_errors([self.batcherr[key].format(*args)
+                          for key, *args in problems])
+        return False
+
+    def show_errors(self, msgs):
+        """ Logs all error messages and shows the first of them to
+            an user. """
+        for msg in msgs:
+            self.logger.error(msg)
+        shown = msgs[:self.max_errors]
+        if len(msgs) > self.max_errors:
+            shown.append(self.batcherr['more'].format(
+                len(msgs) - self.max_errors))
+        self.view.showerr("\n".join(shown))
+
+    def get_csv_options(self):
+        """ Returns options of the CSV import read from a config file
+            with default values for missing ones. """
+        options = {}
+        for key, val in self.csv_options.items():
+            options[key] = self.config.get('csv_import', key, fallback=val)
+        options['header'] = options['header'].lower() in ('yes', 'true',
+                                                          'on', '1')
+        brands = dict(self.csv_brands)
+        brands.update(self.config.items('csv_brands'))
+        options['brands'] = brands
+        return options
+
+    def get_shard(self):
+        """ Returns a sharding scheme and a prefix width read from
+            a config file, or None if orders aren't sharded. """
+        scheme = self.config.get('layout', 'shard', fallback='none')
+        scheme = scheme.strip().lower()
+        if scheme not in self.model.shard_schemes:
+            self.logger.warning(self.configerr['shard'].format(scheme))
+            return None
+        if scheme == 'none':
+            return None
+        try:
+            width = int(self.config.get('layout', 'shard_width',
+                                        fallback=self.shard_width))
+        except ValueError:
+            width = self.shard_width
+        return scheme, max(width, 1)
+
+    def create_plan(self, order):
+        """ Creates a plan of the whole batch inserted by an user or
+            imported from a CSV file. """
+        dirs, files = self.create_layout(order)
+        if order.get('csv'):
+            return self.model.make_csv_plan(order['top'],
+                                            order['csv'],
+                                            order['brand'],
+                                            dirs,
+                                            files,
+                                            self.get_shard(),
+                                            **self.get_csv_options())
+        return self.model.make_plan(order['top'],
+                                    order['inp'],
+                                    order['brand'],
+                                    dirs,
+                                    files,
+                                    self.get_shard())
+
+    def create_root(self, plan, top):
+        """ Creates a directory tree of every order in a plan under
+            a single root, each order under its lock. An order locked
+            by another run for too long is skipped, any other error
+            stops the root, so an unavailable root fails fast. Returns
+            a result dictionary. """
+        result = {'top': top, 'created': 0, 'locked': [], 'error': None}
+        if not os.path.isdir(top):
+            result['error'] = self.runerr['notdir']
+            return result
+        shards = set()
+        try:
+            for topdir in plan.topdirs:
+                head = os.path.dirname(topdir)
+                if head and head not in shards:
+                    self.model.make_shard(top, head)
+                    shards.add(head)
+                try:
+                    with self.model.lock_order(top, topdir):
+                        self.model.make_dir_tree(top, topdir, plan.dirs)
+                        if plan.files:
+                            self.model.make_file_tree(top, topdir,
+                                                      plan.files)
+                except TimeoutError:
+                    result['locked'].append(topdir)
+                    continue
+                result['created'] += 1
+        except OSError as e:
+            result['error'] = str(e)
+        return result
+
+    def create_dirs(self, plan):
+        """ Creates a plan in all its roots concurrently. A failure or
+            a slow share in one root doesn't affect the others. Returns
+            a list of results in the order of roots. """
+        if len(plan.tops) == 1:
+            return [self.create_root(plan, plan.tops[0])]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(plan.tops)) as executor:
+            futures = [executor.submit(self.create_root, plan, top)
+                       for top in plan.tops]
+        return [f.result() for f in futures]
+
+    def iter_created(self, plan, results):
+        """ Yields paths of orders created in all roots. """
+        for r in results:
+            locked = set(r['locked'])
+            done = plan.topdirs[:r['created'] + len(locked)]
+            for topdir in done:
+                if topdir not in locked:
+                    yield os.path.join(r['top'], topdir)
+
+    def get_hook_options(self):
+        """ Returns options of hooks read from a config file with
+            default values for missing or invalid ones. """
+        options = {}
+        for key, val in self.hook_options.items():
+            try:
+                options[key] = max(int(self.config.get('hook_options', key,
+                                                       fallback=val)), 1)
+            except ValueError:
+                options[key] = val
+        return options
+
+    def run_hooks(self, plan, results):
+        """ Runs hooks configured in the [hooks] section of a config
+            file for all created orders. """
+        hooks = list(self.config.items('hooks').items())
+        if not hooks:
+            return []
+        paths = list(self.iter_created(plan, results))
+        if not paths:
+            return []
+        options = self.get_hook_options()
+        self.model.hook_timeout = options['timeout']
+        return self.model.run_hooks(hooks, paths, options['batch_size'],
+                                    options['workers'])
+
+    def summarize(self, plan, results, hooks=()):
+        """ Logs results of all roots and hooks and returns a status
+            message. Failures are also reported to an user. """
+        summary = []
+        msgs = []
+        for r in results:
+            msgs.extend(self.runerr['locked'].format(
+                os.path.join(r['top'], topdir)) for topdir in r['locked'])
+            if r['error']:
+                msgs.append(self.runerr['root'].format(r['top'],
+                                                       r['created'],
+                                                       len(plan),
+                                                       r['error']))
+                summary.append("{}: failed".format(r['top']))
+            else:
+                summary.append("{}: {}".format(r['top'], r['created']))
+        for h in hooks:
+            msgs.extend(self.runerr['hook'].format(h['name'], error)
+                        for error in h['errors'])
+            summary.append("{}: {} batches, {:.1f} s{}".format(
+                h['name'], h['batches'], h['seconds'],
+                ", {} failed".format(len(h['errors'])) if h['errors']
+                else ''))
+        if msgs:
+            self.show_errors(msgs)
+        return " ".join(("Done!", "; ".join(summary)))
+
+    def execute(self, order):
+        """ Creates all orders of a validated batch. """
+        self.write_config(order)
+        try:
+            plan = self.create_plan(order)
+        except (OSError, ValueError, csv.Error) as e:
+            msg = self.runerr['import'].format(e)
+            self.logger.error(msg)
+            self.view.showerr(msg)
+            return
+        if not self.validate_plan(plan):
+            return
+        results = self.create_dirs(plan)
+        hooks = self.run_hooks(plan, results)
+        self.view.set_statusmsg(self.summarize(plan, results, hooks))
+
+    def upgrade(self):
+        """ Completes the current layout in existing orders of all
+            roots. """
+        top = self.get_top()
+        if not self.model.verify_top(top):
+            self.view.showerr(self.validerr['top'])
+            return
+        if not self.view.confirm(self.runerr['confirm'].format(top)):
+            return
+        groups = self.create_upgrade_groups()
+        summary = []
+        errors = []
+        for root in self.model.split_top(top):
+            try:
+                r = self.model.upgrade_top(root, groups, self.max_workers)
+            except OSError as e:
+                errors.append((root, e.strerror or str(e)))
+                summary.append("{}: failed".format(root))
+                continue
+            errors.extend(r['errors'])
+            summary.append("{}: {} upgraded, {} up to date, {} failed"
+                           .format(root, r['upgraded'], r['skipped'],
+                                   len(r['errors'])))
+        if errors:
+            self.show_errors([self.runerr['upgrade'].format(*e)
+                              for e in errors])
+        self.view.set_statusmsg(" ".join(("Done!", "; ".join(summary))))
+
+    def rebalance(self):
+        """ Moves orders lying directly in roots into their shards. """
+        top = self.get_top()
+        if not self.model.verify_top(top):
+            self.view.showerr(self.validerr['top'])
+            return
+        shard = self.get_shard()
+        if not shard:
+            self.view.showerr(self.configerr['noshard'])
+            return
+        if not self.view.confirm(
+                self.runerr['rebalance_confirm'].format(top)):
+            return
+        layout_names = self.model.layout_names(self.create_upgrade_groups())
+        summary = []
+        errors = []
+        for root in self.model.split_top(top):
+            try:
+                r = self.model.rebalance_top(root, shard, layout_names,
+                                             self.max_workers)
+            except OSError as e:
+                errors.append((root, e.strerror or str(e)))
+                summary.append("{}: failed".format(root))
+                continue
+            errors.extend(r['errors'])
+            summary.append("{}: {} moved, {} not orders, {} failed".format(
+                root, r['moved'], r['skipped'], len(r['errors'])))
+        if errors:
+            self.show_errors([self.runerr['rebalance'].format(*e)
+                              for e in errors])
+        self.view.set_statusmsg(" ".join(("Done!", "; ".join(summary))))
+
+    def find_order(self, order_id):
+        """ Shows paths of an order with the selected brand in all
+            roots. Paths are computed, not searched for. """
+        brand = self.get_brand()
+        topdir = self.model.join_brand(order_id.strip(), brand)
+        topdir = self.model.shard_topdir(topdir, self.get_shard(), brand)
+        found = []
+        for root in self.model.split_top(self.get_top()):
+            path = os.path.join(root, topdir)
+            if os.path.isdir(path):
+                found.append(path)
+        if found:
+            self.view.set_statusmsg("; ".join(found))
+        else:
+            self.view.set_statusmsg(
+                "Not found: {}".format(topdir))
 
     def run(self):
         """ Main function of the Controller. """
         order = self.create_order_dict()
         if self.validate_data(order):
-            self.write_config('top', order['top'])
-            self.create_dirs(order)
-            self.view.set_statusmsg("Done!")
+            self.execute(order)
+
+    def run_import(self, path):
+        """ Creates orders imported from a GOCAT CSV export. """
+        order = self.create_order_dict()
+        order['csv'] = path
+        if self.validate_data(order):
+            self.execute(order)
 
 
 class AppView:
@@ -258,6 +1337,10 @@ class AppView:
         self.make_02 = tk.BooleanVar()
         self.make_pdf = tk.BooleanVar()
         self.statusmsg = tk.StringVar()
+        self.previewmsg = tk.StringVar()
+        self.preview_delay = 200
+        self.preview_job = None
+        self.create_menu()
         self.create_inputfield()
         self.create_top_selector()
         self.create_option_selector()
@@ -271,25 +1354,68 @@ class AppView:
     def mainloop(self):
         self.root.mainloop()
 
+    def create_menu(self):
+        menubar = tk.Menu(self.root)
+        filemenu = tk.Menu(menubar, tearoff=0)
+        filemenu.add_command(command=self.ask_csv,
+                             label="Import CSV...")
+        filemenu.add_separator()
+        filemenu.add_command(command=self._quit,
+                             label="Exit")
+        menubar.add_cascade(label="File", menu=filemenu)
+        toolsmenu = tk.Menu(menubar, tearoff=0)
+        toolsmenu.add_command(command=self.ask_order,
+                              label="Find order...")
+        toolsmenu.add_command(command=self.upgrade,
+                              label="Upgrade existing orders")
+        toolsmenu.add_command(command=self.rebalance,
+                              label="Move orders into shards")
+        menubar.add_cascade(label="Tools", menu=toolsmenu)
+        self.root.config(menu=menubar)
+
+    def ask_csv(self):
+        path = filedialog.askopenfilename(
+            filetypes=[("CSV files", "*.csv"), ("All files", "*.*")])
+        if path:
+            self.controller.run_import(path)
+
     def create_top_selector(self):
         frame = ttk.Frame(self.root, padding=5)
         ttk.Button(frame,
                    command=self.ask_top,
                    text="Browse...").pack(side=tk.LEFT)
-        ttk.Entry(frame,
-                  textvariable=self.top,
-                  width=50).pack(expand=1,
-                                 fill=tk.X)
+        ttk.Button(frame,
+                   command=self.add_top,
+                   text="Add...").pack(side=tk.LEFT)
+        self.top_selector = ttk.Combobox(frame,
+                                         textvariable=self.top,
+                                         width=50)
+        self.top_selector.bind('<<ComboboxSelected>>', self.select_top)
+        self.top_selector.pack(expand=1, fill=tk.X)
         frame.pack(expand=0, fill=tk.BOTH, side=tk.TOP)
 
     def set_top(self, d):
         self.top.set(d)
 
+    def set_recent_tops(self, tops):
+        self.top_selector['values'] = tops
+
+    def select_top(self, event=None):
+        self.controller.select_top(self.get_top())
+
     def ask_top(self):
         d = filedialog.askdirectory(initialdir=self.get_top())
         if d:
             self.set_top(d)
 
+    def add_top(self):
+        """ Appends another root to the top path. The batch is created
+            in all roots separated by os.pathsep. """
+        top = self.get_top().strip()
+        d = filedialog.askdirectory(initialdir=top.split(os.pathsep)[-1])
+        if d:
+            self.set_top(os.pathsep.join((top, d)) if top else d)
+
     def get_top(self):
         return self.top.get()
 
@@ -320,9 +1446,15 @@ class AppView:
     def showerr(self, msg):
         messagebox.showerror(title='Error', message=msg)
 
+    def confirm(self, msg):
+        return messagebox.askyesno(title='Confirm', message=msg)
+
     def get_brand(self):
         return self.brand.get()
 
+    def set_brand(self, brand):
+        self.brand.set(brand)
+
     def get_input(self):
         inp = self.scrolltext.get('1.0', tk.END)
         return inp
@@ -330,9 +1462,15 @@ class AppView:
     def get_make_02(self):
         return self.make_02.get()
 
+    def set_make_02(self, val):
+        self.make_02.set(val)
+
     def get_make_pdf(self):
         return self.make_pdf.get()
 
+    def set_make_pdf(self, val):
+        self.make_pdf.set(val)
+
     def create_inputfield(self):
         frame = ttk.Frame(self.root, padding=5)
         ttk.Label(frame, text="Insert text:").pack(fill=tk.X,
@@ -342,7 +1480,74 @@ class AppView:
                                                        width=45,
                                                        wrap=tk.WORD)
         self.scrolltext.pack(expand=1, fill=tk.BOTH)
+        ttk.Label(frame,
+                  textvariable=self.previewmsg).pack(fill=tk.X)
         frame.pack(expand=1, fill=tk.BOTH, side=tk.TOP)
+        self.watch_input()
+
+    def watch_input(self):
+        """ Replaces the Tcl command of the input field with a proxy,
+            which reports every edited range of lines. """
+        widget = self.scrolltext
+        self.scrolltext_cmd = widget._w + '_orig'
+        widget.tk.call('rename', widget._w, self.scrolltext_cmd)
+        widget.tk.createcommand(widget._w, self.input_proxy)
+
+    def input_line(self, index, last):
+        """ Returns a line number of an index, at most the last one. """
+        line = self.root.tk.call(self.scrolltext_cmd, 'index', index)
+        return min(int(str(line).split('.')[0]), last)
+
+    @staticmethod
+    def input_range(cmd, args, line, total):
+        """ Returns the first and the last line touched by an insert,
+            delete or replace command, or None if the range is reversed
+            and nothing changes. The line function maps an index to its
+            line number. """
+        first = line(args[0])
+        if cmd == 'insert':
+            return first, first
+        if cmd == 'delete' and len(args) > 2:
+            return 1, total
+        if len(args) > 1:
+            last = line(args[1])
+        else:
+            last = line(str(args[0]) + '+1c')
+        if last < first:
+            return None
+        return first, last
+
+    def input_proxy(self, cmd, *args):
+        call = self.root.tk.call
+        if cmd not in ('insert', 'delete', 'replace'):
+            return call((self.scrolltext_cmd, cmd) + args)
+        total = self.input_line('end-1c', sys.maxsize)
+        edited = self.input_range(
+            cmd, args, lambda index: self.input_line(index, total), total)
+        result = call((self.scrolltext_cmd, cmd) + args)
+        if edited is None:
+            return result
+        first, last = edited
+        last_now = last + self.input_line('end-1c', sys.maxsize) - total
+        lines = call(self.scrolltext_cmd, 'get', '{}.0'.format(first),
+                     '{}.end'.format(last_now))
+        self.controller.edit_input(first - 1, last, str(lines).split('\n'))
+        self.schedule_preview()
+        return result
+
+    def schedule_preview(self):
+        """ Refreshes the preview once an user stops typing. """
+        if self.preview_job:
+            self.root.after_cancel(self.preview_job)
+        self.preview_job = self.root.after(self.preview_delay,
+                                           self.show_preview)
+
+    def show_preview(self):
+        self.preview_job = None
+        self.controller.show_preview()
+
+    def set_previewmsg(self, msg):
+        self.previewmsg.set(msg)
 
     def create_button(self):
         frame = ttk.Frame(self.root, padding=5)
@@ -371,6 +1576,18 @@ class AppView:
     def run(self):
         self.controller.run()
 
+    def upgrade(self):
+        self.controller.upgrade()
+
+    def rebalance(self):
+        self.controller.rebalance()
+
+    def ask_order(self):
+        order_id = simpledialog.askstring("Find order", "Order ID:",
+                                          parent=self.root)
+        if order_id and order_id.strip():
+            self.controller.find_order(order_id)
+
     def _quit(self):
         self.root.quit()
         self.root.destroy()
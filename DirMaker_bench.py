@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Memory benchmark of a batch creation. Every variant is run in a
+    separate process, so its peak RSS is measured in isolation. The peak
+    of memory allocated by the creation alone is traced by tracemalloc,
+    started only after the input is built. The file system is not
+    touched: directories, files and order locks are replaced by
+    no-ops and the root is assumed to exist.
+
+    Usage: python DirMaker_bench.py [number_of_orders]
+"""
+
+import contextlib
+import io
+import os
+import re
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+import DirMaker
+
+
+def make_input(counter):
+    """ Builds a paste similar to a GOCAT order list. """
+    return '\n'.join('VRL{:06d} - V12.0_Golf Sportsvan_2015_6 Gang-Sc...'
+                     .format(i) for i in range(counter))
+
+
+def peak_rss():
+    """ Returns peak RSS of the current process in kB. """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def legacy_create_dirs(controller, order):
+    """ The batch creation before the compact plan was introduced. """
+    inp = []
+    for i in order['inp'].splitlines():
+        s = re.search(r'\w+', i)
+        if s:
+            inp.append(s.group())
+    topdir_list = []
+    for topdir in inp:
+        topdir_list.append(topdir + '_' + order['brand'])
+    model = controller.model
+    for topdir in topdir_list:
+        model.make_dir_tree(order['top'], topdir, controller.basic_dirs)
+        model.make_dir_tree(order['top'], topdir, controller.dirs_02)
+        model.make_file_tree(order['top'], topdir, controller.files_02)
+        model.make_file_tree(order['top'], topdir, controller.no_pdf)
+
+
+def plan_create_dirs(controller, order):
+    """ The batch creation based on the compact plan. """
+    plan = controller.create_plan(order)
+    for result in controller.create_dirs(plan):
+        if result['error'] or result['created'] != len(plan.topdirs):
+            raise RuntimeError("Plan not created: {}".format(result))
+
+
+def measure(variant, counter):
+    """ Runs a single variant and prints its peak RSS. """
+    DirMaker.os.makedirs = lambda *args, **kwargs: None
+    DirMaker.os.path.isdir = lambda path: True
+    DirMaker.open = lambda *args: io.StringIO()
+    DirMaker.AppModel.lock_order = lambda *args: contextlib.suppress()
+    controller = DirMaker.AppController()
+    controller.init_model()
+    controller.config = DirMaker.SettingsStore(os.devnull)
+    order = {'top': os.path.normpath('/mnt/share/orders'),
+             'brand': 'VW11',
+             'inp': make_input(counter),
+             'make_02': True,
+             'make_pdf': True}
+    create = {'legacy': legacy_create_dirs,
+              'plan': plan_create_dirs}[variant]
+    tracemalloc.start()
+    create(controller, order)
+    traced = tracemalloc.get_traced_memory()[1] // 1024
+    tracemalloc.stop()
+    print(variant, traced, peak_rss())
+
+
+def main():
+    if len(sys.argv) > 2:
+        measure(sys.argv[1], int(sys.argv[2]))
+        return
+    counter = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("orders: {}".format(counter))
+    for variant in ('legacy', 'plan'):
+        out = subprocess.check_output([sys.executable, __file__,
+                                       variant, str(counter)])
+        name, traced, peak = out.decode().split()
+        print("{:>6}: peak allocated {:>8} kB, peak RSS {:>8} kB".format(
+            name, traced, peak))
+
+
+if __name__ == '__main__':
+    main()
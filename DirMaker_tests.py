@@ -2,13 +2,43 @@
 # -*- coding: utf-8 -*-
 
 import configparser
-import io
 import DirMaker
 import os
+import re
+import shlex
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 
+# Some tests replace file system functions for good, the real ones are
+# restored by tests working on a temporary directory.
+REAL_FS = {'makedirs': os.makedirs,
+           'isdir': os.path.isdir,
+           'isfile': os.path.isfile}
+
+
+class TempDirMixin:
+
+    def setUp(self):
+        for patch in (mock.patch('DirMaker.os.makedirs',
+                                 REAL_FS['makedirs']),
+                      mock.patch('DirMaker.os.path.isdir',
+                                 REAL_FS['isdir']),
+                      mock.patch('DirMaker.os.path.isfile',
+                                 REAL_FS['isfile'])):
+            patch.start()
+            self.addCleanup(patch.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.top = tmp.name
+
+    def listdir(self, *path):
+        return sorted(os.listdir(os.path.join(self.top, *path)))
+
 
 class TestAppModel(unittest.TestCase):
 
@@ -24,6 +54,21 @@ class TestAppModel(unittest.TestCase):
             result = self.m.verify_top(top)
             self.assertFalse(result)
 
+    def test_verify_top_roots(self):
+        top = os.pathsep.join(('/home', '/mnt/backup'))
+        with mock.patch('DirMaker.os.path.isdir') as misdir:
+            misdir.side_effect = [False, True, False, False]
+            self.assertTrue(self.m.verify_top(top))
+            self.assertFalse(self.m.verify_top(top))
+            misdir.assert_called_with('/mnt/backup')
+        self.assertFalse(self.m.verify_top(' ' + os.pathsep))
+
+    def test_split_top(self):
+        top = os.pathsep.join((' /home', '', '/mnt/backup ', '/home'))
+        result = self.m.split_top(top)
+        self.assertListEqual(result, ['/home', '/mnt/backup'])
+        self.assertListEqual(self.m.split_top('/home'), ['/home'])
+
     def test_verify_brand(self):
         result = self.m.verify_brand('')
         self.assertFalse(result)
@@ -78,6 +123,152 @@ class TestAppModel(unittest.TestCase):
         result = self.m.add_brand(dir_list)
         self.assertListEqual(result, out)
 
+    def test_iter_dir_name(self):
+        inp = "A1 - x\r\n\r\n  -- \rB2\x0cC3 D4\u2028 E5"
+        result = list(self.m.iter_dir_name(inp))
+        self.assertListEqual(result, ['A1', 'B2', 'C3', 'E5'])
+        self.assertListEqual(result, [re.search(r'\w+', i).group()
+                                      for i in inp.splitlines()
+                                      if re.search(r'\w+', i)])
+
+    def test_iter_topdir(self):
+        result = self.m.iter_topdir(iter(['A1', 'B2']), 'Seat')
+        self.assertListEqual(list(result), ['A1_Seat', 'B2_Seat'])
+        result = self.m.iter_topdir(iter(['A1', 'B2']), 'Empty')
+        self.assertListEqual(list(result), ['A1', 'B2'])
+
+    def test_make_plan(self):
+        plan = self.m.make_plan('/home', "A1\nB2 - x\n", 'Audi',
+                                [("01_poczatek",)],
+                                [("02_przygotowanie", "01_DE.pdf")])
+        self.assertTupleEqual(plan.tops, ('/home',))
+        self.assertTupleEqual(plan.topdirs, ('A1_Audi', 'B2_Audi'))
+        self.assertTupleEqual(plan.dirs, (("01_poczatek",),))
+        self.assertTupleEqual(plan.files, ((os.path.join(
+            "02_przygotowanie", "01_DE.pdf"),),))
+        self.assertListEqual(list(plan), ['A1_Audi', 'B2_Audi'])
+        with self.assertRaises(AttributeError):
+            plan.extra = None
+
+    def write_csv(self, data, encoding='utf-8-sig'):
+        f = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        self.addCleanup(os.remove, f.name)
+        f.write(data.encode(encoding))
+        f.close()
+        return f.name
+
+    def test_iter_csv_orders(self):
+        path = self.write_csv(
+            'Nr zlecenia;Model;Jezyki\r\n'
+            'ARL005853 - x;V11.0_Audi A4_2015;DE-PL\r\n'
+            '"VRL011916";"V12.0_Golf ""Sportsvan""\r\n2015";DE-PL\r\n'
+            ';V6.0_Seat;DE-PL\r\n'
+            'OC0000789\r\n'
+            'SRL000001;V1.0_Seat Leon;DE-PL\r\n')
+        brands = {'audi': 'Audi', 'seat': 'Seat'}
+        result = self.m.iter_csv_orders(path, 'nr zlecenia', 'MODEL',
+                                        delimiter=';', brands=brands)
+        self.assertListEqual(list(result), [('ARL005853', 'Audi'),
+                                            ('VRL011916', None),
+                                            ('OC0000789', None),
+                                            ('SRL000001', 'Seat')])
+        result = self.m.iter_csv_orders(path, '1', '2', header=False,
+                                        delimiter=';', brands=brands)
+        self.assertEqual(next(result), ('Nr', None))
+        self.assertEqual(next(result), ('ARL005853', 'Audi'))
+        with self.assertRaises(ValueError):
+            list(self.m.iter_csv_orders(path, 'ID', delimiter=';'))
+        with self.assertRaises(ValueError):
+            list(self.m.iter_csv_orders(path, '0', delimiter=';'))
+        path = self.write_csv('')
+        self.assertListEqual(list(self.m.iter_csv_orders(path, '1')), [])
+
+    def test_iter_csv_orders_utf16(self):
+        path = self.write_csv('ID\tModel\r\nA1\tŠkoda Octavia\r\n'
+                              'B2\tAudi\r\n', 'utf-16')
+        result = self.m.iter_csv_orders(path, 'ID', 'Model',
+                                        delimiter='\t', encoding='utf-16',
+                                        brands={'audi': 'Audi'})
+        self.assertListEqual(list(result), [('A1', None), ('B2', 'Audi')])
+
+    def test_iter_mmap_lines(self):
+        data = 'A1;Żółw\r\nB2;"x\ny"\nC3'.encode('utf-8-sig')
+        result = list(self.m.iter_mmap_lines(data, 'utf-8-sig', 3))
+        self.assertListEqual(result, ['A1;Żółw\r\n', 'B2;"x\n', 'y"\n',
+                                      'C3'])
+
+    def test_make_csv_plan(self):
+        path = self.write_csv('ID,Model\nA1,Audi A4\nB2,Golf\n')
+        plan = self.m.make_csv_plan('/home', path, 'VW11',
+                                    [("01_poczatek",)], [],
+                                    id_column='ID', model_column='Model',
+                                    brands={'audi': 'Audi'})
+        self.assertTupleEqual(plan.topdirs, ('A1_Audi', 'B2_VW11'))
+        plan = self.m.make_csv_plan('/home', path, 'Empty', [], [],
+                                    ('brand', 5), id_column='ID',
+                                    model_column='Model',
+                                    brands={'audi': 'Audi'})
+        self.assertTupleEqual(plan.topdirs, (os.path.join('Audi', 'A1_Audi'),
+                                             os.path.join('Empty', 'B2')))
+
+    def test_validate_plan(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        top = tmp.name
+        os.mkdir(os.path.join(top, 'oc0000789_Audi'))
+        missing = os.path.join(top, 'missing')
+        long_name = 'A' * (self.m.max_path - len(top) - 12)
+        topdirs = ['OC0000789_Audi', 'A1', 'a1', 'A1', 'con', 'NUL.txt',
+                   long_name]
+        plan = DirMaker.OrderPlan([top, missing], topdirs,
+                                  [("01_poczatek",)])
+        result = self.m.validate_plan(plan)
+        self.assertListEqual(result, [
+            ('collision', 'a1', 'A1'),
+            ('duplicate', 'A1'),
+            ('reserved', 'con'),
+            ('reserved', 'NUL.txt'),
+            ('existing', 'OC0000789_Audi',
+             os.path.join(top, 'oc0000789_Audi')),
+            ('length', os.path.join(top, long_name))])
+        plan = DirMaker.OrderPlan([top], ['oc0000789_Audi', 'A1'])
+        self.assertListEqual(self.m.validate_plan(plan), [])
+
+    def test_validate_plan_sharded_reserved(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        plan = self.m.make_plan(tmp.name, 'COM1\nCON\nCOM12\n', 'Empty', [],
+                                [], ('prefix', 4))
+        self.assertListEqual(self.m.validate_plan(plan), [
+            ('reserved', os.path.join('COM1', 'COM1')),
+            ('reserved', os.path.join('CON', 'CON')),
+            ('reserved', os.path.join('COM1', 'COM12'))])
+
+    def test_shard_topdir(self):
+        result = self.m.shard_topdir('vrl011916_VW11', ('prefix', 5))
+        self.assertEqual(result, os.path.join('VRL01', 'vrl011916_VW11'))
+        result = self.m.shard_topdir('VRL011916_VW11', ('brand', 5))
+        self.assertEqual(result, os.path.join('VW11', 'VRL011916_VW11'))
+        result = self.m.shard_topdir('OC0000789', ('brand', 5))
+        self.assertEqual(result, os.path.join('Empty', 'OC0000789'))
+        result = self.m.shard_topdir('AB_12', ('brand', 5), 'Empty')
+        self.assertEqual(result, os.path.join('Empty', 'AB_12'))
+        result = self.m.shard_topdir('AB_12_Audi', ('brand', 5), 'Audi')
+        self.assertEqual(result, os.path.join('Audi', 'AB_12_Audi'))
+        self.assertEqual(self.m.shard_topdir('OC0000789'), 'OC0000789')
+        result = self.m.shard_topdir('OC0000789', ('none', 5))
+        self.assertEqual(result, 'OC0000789')
+
+    def test_make_plan_sharded(self):
+        plan = self.m.make_plan('/home', "AB_12\n", 'Empty', [], [],
+                                ('brand', 5))
+        self.assertTupleEqual(plan.topdirs, (os.path.join('Empty', 'AB_12'),))
+        plan = self.m.make_plan('/home', "A1\nBB2\n", 'Audi', [], [],
+                                ('prefix', 2))
+        self.assertTupleEqual(plan.topdirs, (os.path.join('A1', 'A1_Audi'),
+                                             os.path.join('BB',
+                                                          'BB2_Audi')))
+
     def test_make_dir_tree(self):
         top = os.path.normpath('/home')
         topdir = 'VRL011916_VW11'
@@ -98,11 +289,11 @@ class TestAppModel(unittest.TestCase):
         in_files = [("02_przygotowanie", "01_DE.pdf"),
                     ("02_przygotowanie", "02_DE-PL.pdf"),
                     ("02_przygotowanie", "03_PL.pdf"),]
-        calls = [mock.call(os.path.normpath('/home/VRL011916_VW11/02_przygotowanie/01_DE.pdf'), 'w'),
+        calls = [mock.call(os.path.normpath('/home/VRL011916_VW11/02_przygotowanie/01_DE.pdf'), 'x'),
                  mock.call().close(),
-                 mock.call(os.path.normpath('/home/VRL011916_VW11/02_przygotowanie/02_DE-PL.pdf'), 'w'),
+                 mock.call(os.path.normpath('/home/VRL011916_VW11/02_przygotowanie/02_DE-PL.pdf'), 'x'),
                  mock.call().close(),
-                 mock.call(os.path.normpath('/home/VRL011916_VW11/02_przygotowanie/03_PL.pdf'), 'w'),
+                 mock.call(os.path.normpath('/home/VRL011916_VW11/02_przygotowanie/03_PL.pdf'), 'x'),
                  mock.call().close()]
         if sys.version_info < (3, 5):
             with mock.patch('builtins.open') as mopen:
@@ -123,84 +314,605 @@ class TestAppController(unittest.TestCase):
         self.c = DirMaker.AppController()
         self.c.init_model()
         self.c.init_view = mock.Mock()
+        self.c.config = DirMaker.SettingsStore('test.ini')
         self.model_patch = mock.patch.multiple('DirMaker.AppModel',
                                                extract_dir_name=mock.DEFAULT,
                                                add_brand=mock.DEFAULT,
                                                make_dir_tree=mock.DEFAULT,
-                                               make_file_tree=mock.DEFAULT)
+                                               make_file_tree=mock.DEFAULT,
+                                               make_shard=mock.DEFAULT,
+                                               lock_order=mock.DEFAULT)
         self.mp = self.model_patch.start()
+        self.isdir_patch = mock.patch('DirMaker.os.path.isdir',
+                                      return_value=True)
+        self.misdir = self.isdir_patch.start()
+        self.addCleanup(self.isdir_patch.stop)
 
     def tearDown(self):
         self.model_patch.stop()
 
+    def create_order(self, counter, make_02, make_pdf):
+        return {'top': '/home',
+                'brand': 'Audi',
+                'inp': '\n'.join('OC{:07d}'.format(i)
+                                 for i in range(counter)),
+                'make_02': make_02,
+                'make_pdf': make_pdf}
+
     def test_create_dirs_0(self):
-        """ Scenario 0:  """
+        """ Scenario 0: all options selected. """
         counter = 3
-        inp = list(range(counter))
-        self.mp['add_brand'].return_value = inp
-        self.mp['extract_dir_name'].return_value = inp
-        order = {'top': '/home',
-                 'brand': 'VW12',
-                 'inp': inp,
-                 'make_02': True,
-                 'make_pdf': True}
-        result = self.c.create_dirs(order)
-        assert self.mp['extract_dir_name'].call_count == 1
-        assert self.mp['add_brand'].call_count == 1
-        assert self.mp['make_dir_tree'].call_count == 2 * counter
-        assert self.mp['make_file_tree'].call_count == 2 * counter
+        plan = self.c.create_plan(self.create_order(counter, True, True))
+        result = self.c.create_dirs(plan)
+        assert len(plan) == counter
+        assert len(plan.dirs) == 5
+        assert len(plan.files) == 4
+        assert self.mp['make_dir_tree'].call_count == counter
+        assert self.mp['make_file_tree'].call_count == counter
 
     def test_create_dirs_1(self):
-        """ Scenaerio 1:  """
+        """ Scenaerio 1: no options selected. """
         counter = 10
-        inp = list(range(counter))
-        self.mp['extract_dir_name'].return_value = inp
-        self.mp['add_brand'].return_value = inp
-        order = {'top': '/home',
-                 'brand': 'Audi',
-                 'inp': inp,
-                 'make_02': False,
-                 'make_pdf': False}
-        result = self.c.create_dirs(order)
-        assert self.mp['extract_dir_name'].call_count == 1
-        assert self.mp['add_brand'].call_count == 1
+        plan = self.c.create_plan(self.create_order(counter, False, False))
+        result = self.c.create_dirs(plan)
+        assert len(plan.dirs) == 3
         assert self.mp['make_dir_tree'].call_count == counter
         assert not self.mp['make_file_tree'].called
 
     def test_create_dirs_2(self):
-        """ Scenario 2: """
+        """ Scenario 2: only \\02_przygotowanie selected. """
         counter = 21
-        inp = list(range(counter))
-        self.mp['add_brand'].return_value = inp
-        self.mp['extract_dir_name'].return_value = inp
-        order = {'top': '/home',
-                 'brand': 'Audi',
-                 'inp': inp,
-                 'make_02': True,
-                 'make_pdf': False}
-        result = self.c.create_dirs(order)
-        assert self.mp['extract_dir_name'].call_count == 1
-        assert self.mp['add_brand'].call_count == 1
-        assert self.mp['make_dir_tree'].call_count == 2 * counter
+        plan = self.c.create_plan(self.create_order(counter, True, False))
+        result = self.c.create_dirs(plan)
+        assert len(plan.files) == 3
+        assert self.mp['make_dir_tree'].call_count == counter
         assert self.mp['make_file_tree'].call_count == counter
 
     def test_create_dirs_3(self):
-        """ Scenario 3: """
+        """ Scenario 3: empty input. """
         counter = 0
-        inp = list(range(counter))
-        self.mp['add_brand'].return_value = inp
-        self.mp['extract_dir_name'].return_value = inp
-        order = {'top': '/home',
-                 'brand': 'Audi',
-                 'inp': inp,
-                 'make_02': True,
-                 'make_pdf': True}
-        result = self.c.create_dirs(order)
-        assert self.mp['extract_dir_name'].call_count == 1
-        assert self.mp['add_brand'].call_count == 1
+        plan = self.c.create_plan(self.create_order(counter, True, True))
+        result = self.c.create_dirs(plan)
         assert not self.mp['make_dir_tree'].called
         assert not self.mp['make_file_tree'].called
 
+    def test_create_dirs_roots(self):
+        """ Every root is created independently and concurrently. """
+        order = self.create_order(3, False, False)
+        order['top'] = os.pathsep.join(('/slow', '/fast', '/broken'))
+        fast_done = threading.Event()
+
+        def make_dir_tree(top, topdir, tree):
+            if top == '/slow' and not fast_done.wait(5):
+                raise OSError("/slow blocked by another root")
+            if top == '/broken' and topdir == 'OC0000001_Audi':
+                raise OSError("Share unavailable")
+            if top == '/fast' and topdir == 'OC0000002_Audi':
+                fast_done.set()
+
+        self.mp['make_dir_tree'].side_effect = make_dir_tree
+        plan = self.c.create_plan(order)
+        result = self.c.create_dirs(plan)
+        self.assertListEqual(result, [
+            {'top': '/slow', 'created': 3, 'locked': [], 'error': None},
+            {'top': '/fast', 'created': 3, 'locked': [], 'error': None},
+            {'top': '/broken', 'created': 1, 'locked': [],
+             'error': "Share unavailable"}])
+        assert self.mp['lock_order'].call_count == 8
+
+    def test_create_dirs_unreachable(self):
+        """ An unreachable root fails, the others are created. """
+        order = self.create_order(2, False, False)
+        order['top'] = os.pathsep.join(('/home', '/offline'))
+        self.misdir.side_effect = lambda top: top == '/home'
+        result = self.c.create_dirs(self.c.create_plan(order))
+        self.assertListEqual(result, [
+            {'top': '/home', 'created': 2, 'locked': [], 'error': None},
+            {'top': '/offline', 'created': 0, 'locked': [],
+             'error': "Directory not found"}])
+        assert self.mp['make_dir_tree'].call_count == 2
+
+    def test_create_dirs_locked(self):
+        """ An order locked by another run is skipped. """
+        order = self.create_order(3, False, False)
+        self.mp['lock_order'].side_effect = [mock.MagicMock(),
+                                             TimeoutError(),
+                                             mock.MagicMock()]
+        plan = self.c.create_plan(order)
+        result = self.c.create_dirs(plan)
+        self.assertListEqual(result, [
+            {'top': '/home', 'created': 2, 'locked': ['OC0000001_Audi'],
+             'error': None}])
+        assert self.mp['make_dir_tree'].call_count == 2
+
+    def test_create_dirs_sharded(self):
+        self.c.config.config.read_dict({'layout': {'shard': 'Prefix',
+                                                   'shard_width': '3'}})
+        order = self.create_order(3, False, False)
+        order['inp'] += '\nAR1\n'
+        order['top'] = os.pathsep.join(('/home', '/mnt'))
+        plan = self.c.create_plan(order)
+        self.c.create_dirs(plan)
+        self.assertEqual(plan.topdirs[0], os.path.join('OC0',
+                                                       'OC0000000_Audi'))
+        self.mp['make_shard'].assert_has_calls(
+            [mock.call('/home', 'OC0'), mock.call('/home', 'AR1'),
+             mock.call('/mnt', 'OC0'), mock.call('/mnt', 'AR1')],
+            any_order=True)
+        assert self.mp['make_shard'].call_count == 4
+
+    def test_iter_created(self):
+        plan = self.c.create_plan(self.create_order(4, False, False))
+        results = [{'top': '/a', 'created': 4, 'locked': [],
+                    'error': None},
+                   {'top': '/b', 'created': 1, 'locked': ['OC0000001_Audi'],
+                    'error': "Oops"}]
+        result = list(self.c.iter_created(plan, results))
+        self.assertListEqual(result, [
+            os.path.join('/a', 'OC000000{}_Audi'.format(i))
+            for i in range(4)] + [os.path.join('/b', 'OC0000000_Audi')])
+
+    def test_run_hooks(self):
+        plan = self.c.create_plan(self.create_order(3, False, False))
+        results = [{'top': '/a', 'created': 3, 'locked': [],
+                    'error': None}]
+        self.c.model.run_hooks = mock.Mock(return_value=[])
+        self.assertListEqual(self.c.run_hooks(plan, results), [])
+        assert not self.c.model.run_hooks.called
+        self.c.config.config.read_dict({
+            'hooks': {'acl': 'setacl.exe /q'},
+            'hook_options': {'batch_size': '2', 'workers': 'many'}})
+        self.c.run_hooks(plan, results)
+        paths = list(self.c.iter_created(plan, results))
+        self.c.model.run_hooks.assert_called_once_with(
+            [('acl', 'setacl.exe /q')], paths, 2, 4)
+
+    def test_summarize_hooks(self):
+        self.c.view = mock.Mock()
+        self.c.logger = mock.Mock()
+        plan = self.c.create_plan(self.create_order(3, False, False))
+        results = [{'top': '/home', 'created': 3, 'locked': [],
+                    'error': None}]
+        hooks = [{'name': 'acl', 'batches': 2, 'seconds': 1.25,
+                  'errors': []},
+                 {'name': 'tracker', 'batches': 2, 'seconds': 0.5,
+                  'errors': ["Exit code 1: denied"]}]
+        result = self.c.summarize(plan, results, hooks)
+        self.assertEqual(result, "Done! /home: 3; acl: 2 batches, 1.2 s; "
+                                 "tracker: 2 batches, 0.5 s, 1 failed")
+        self.c.view.showerr.assert_called_once_with(
+            "Hook tracker failed: Exit code 1: denied")
+
+    def test_get_shard(self):
+        self.c.logger = mock.Mock()
+        self.assertIsNone(self.c.get_shard())
+        self.c.config.config.read_dict({'layout': {'shard': 'brand'}})
+        self.assertTupleEqual(self.c.get_shard(), ('brand', 5))
+        self.c.config.config.read_dict({'layout': {'shard': 'year'}})
+        self.assertIsNone(self.c.get_shard())
+        self.c.logger.warning.assert_called_once_with(
+            "Unknown shard scheme: year")
+
+    def test_find_order(self):
+        self.c.view = mock.Mock()
+        self.c.view.get_top.return_value = os.pathsep.join(('/a', '/b'))
+        self.c.view.get_brand.return_value = 'VW11'
+        self.c.config.config.read_dict({'layout': {'shard': 'prefix'}})
+        path = os.path.join('/b', 'VRL01', 'VRL011916_VW11')
+        with mock.patch('DirMaker.os.path.isdir',
+                        side_effect=lambda p: p == path) as misdir:
+            self.c.find_order(' VRL011916 ')
+            assert misdir.call_count == 2
+        self.c.view.set_statusmsg.assert_called_once_with(path)
+        self.c.view.get_brand.return_value = 'Empty'
+        self.c.config.config.read_dict({'layout': {'shard': 'brand'}})
+        path = os.path.join('/a', 'Empty', 'AB_12')
+        with mock.patch('DirMaker.os.path.isdir',
+                        side_effect=lambda p: p == path):
+            self.c.find_order('AB_12')
+        self.c.view.set_statusmsg.assert_called_with(path)
+
+    def test_summarize(self):
+        self.c.view = mock.Mock()
+        self.c.logger = mock.Mock()
+        plan = self.c.create_plan(self.create_order(3, False, False))
+        results = [{'top': '/home', 'created': 2, 'locked': ['A1'],
+                    'error': None},
+                   {'top': '/mnt', 'created': 1, 'locked': [],
+                    'error': "Oops"}]
+        result = self.c.summarize(plan, results)
+        self.assertEqual(result, "Done! /home: 2; /mnt: failed")
+        msgs = [os.path.join('/home', 'A1') +
+                " is locked by another run, skipped.",
+                "/mnt failed after 1 of 3 orders: Oops"]
+        self.c.view.showerr.assert_called_once_with("\n".join(msgs))
+        self.c.logger.error.assert_has_calls([mock.call(m) for m in msgs])
+
+    def test_create_plan(self):
+        order = self.create_order(2, True, False)
+        plan = self.c.create_plan(order)
+        self.assertTupleEqual(plan.topdirs, ('OC0000000_Audi',
+                                             'OC0000001_Audi'))
+        self.assertIn((os.path.join("02_przygotowanie",
+                                    "01_sdlxliff_orig"),), plan.dirs)
+        other = self.c.create_plan(order)
+        for a, b in zip(plan.dirs + plan.files, other.dirs + other.files):
+            self.assertIs(a[0], b[0])
+
+
+class TestUpgrade(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.m = DirMaker.AppModel()
+        self.groups = ((None, (("01_poczatek",), ("90_koniec",)), ()),
+                       ("02_przygotowanie",
+                        (("02_przygotowanie", "01_sdlxliff_orig"),),
+                        (("02_przygotowanie", "01_DE.pdf"),)))
+        self.version = self.m.layout_version(self.groups)
+        self.marker = self.m.layout_marker + self.version
+        os.makedirs(os.path.join(self.top, 'A1', '01_poczatek'))
+        os.makedirs(os.path.join(self.top, 'B2', '02_przygotowanie'))
+        open(os.path.join(self.top, 'B2', '.dirmaker-layout-old'),
+             'w').close()
+        open(os.path.join(self.top, 'notes.txt'), 'w').close()
+        os.makedirs(os.path.join(self.top, '.hidden'))
+        os.makedirs(os.path.join(self.top, 'Archiwum', '2015'))
+
+    def test_upgrade_order(self):
+        result = self.m.upgrade_order(self.top, 'A1', self.groups,
+                                      self.version)
+        self.assertTrue(result)
+        self.assertListEqual(self.listdir('A1'), [self.marker,
+                                                  '01_poczatek',
+                                                  '90_koniec'])
+        result = self.m.upgrade_order(self.top, 'B2', self.groups,
+                                      self.version)
+        self.assertTrue(result)
+        self.assertListEqual(self.listdir('B2'), [self.marker,
+                                                  '01_poczatek',
+                                                  '02_przygotowanie',
+                                                  '90_koniec'])
+        self.assertListEqual(self.listdir('B2', '02_przygotowanie'),
+                             ['01_DE.pdf', '01_sdlxliff_orig'])
+
+    def test_upgrade_order_skipped(self):
+        self.m.upgrade_order(self.top, 'A1', self.groups, self.version)
+        with mock.patch('DirMaker.os.listdir',
+                        wraps=os.listdir) as mlistdir, \
+                mock.patch.object(self.m, 'make_dir_tree') as mmake:
+            result = self.m.upgrade_order(self.top, 'A1', self.groups,
+                                          self.version)
+            self.assertFalse(result)
+            assert mlistdir.call_count == 1
+            assert not mmake.called
+
+    def test_upgrade_top(self):
+        result = self.m.upgrade_top(self.top, self.groups, 4)
+        self.assertDictEqual(result, {'top': self.top, 'upgraded': 2,
+                                      'skipped': 2, 'errors': []})
+        self.assertListEqual(self.listdir('.hidden'), [])
+        self.assertListEqual(self.listdir('Archiwum'), ['2015'])
+        result = self.m.upgrade_top(self.top, self.groups, 4)
+        self.assertDictEqual(result, {'top': self.top, 'upgraded': 0,
+                                      'skipped': 4, 'errors': []})
+
+
+class TestShards(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.m = DirMaker.AppModel()
+        self.shard = ('prefix', 3)
+        self.m.make_shard(self.top, 'VRL')
+        os.makedirs(os.path.join(self.top, 'VRL', 'vrl1_VW11',
+                                 '01_poczatek'))
+        os.makedirs(os.path.join(self.top, 'ARL1_Audi', '01_poczatek'))
+        os.makedirs(os.path.join(self.top, 'VRL2_VW11'))
+        open(os.path.join(self.top, 'notes.txt'), 'w').close()
+
+    def test_make_shard(self):
+        self.m.make_shard(self.top, 'VRL')
+        self.assertListEqual(self.listdir('VRL'), [self.m.shard_marker,
+                                                   'vrl1_VW11'])
+
+    def test_validate_plan(self):
+        topdirs = [self.m.shard_topdir(topdir, self.shard)
+                   for topdir in ('VRL1_VW11', 'OC1_Audi', 'vrl2_VW11')]
+        plan = DirMaker.OrderPlan([self.top], topdirs)
+        result = self.m.validate_plan(plan)
+        self.assertListEqual(result, [
+            ('existing', os.path.join('VRL', 'VRL1_VW11'),
+             os.path.join(self.top, 'VRL', 'vrl1_VW11')),
+            ('existing', os.path.join('VRL', 'vrl2_VW11'),
+             os.path.join(self.top, 'VRL2_VW11'))])
+
+    def test_upgrade_top(self):
+        groups = ((None, (("01_poczatek",), ("90_koniec",)), ()),)
+        result = self.m.upgrade_top(self.top, groups, 4)
+        self.assertDictEqual(result, {'top': self.top, 'upgraded': 2,
+                                      'skipped': 2, 'errors': []})
+        self.assertListEqual(self.listdir('VRL2_VW11'), [])
+        self.assertIn('90_koniec', self.listdir('VRL', 'vrl1_VW11'))
+        self.assertIn('90_koniec', self.listdir('ARL1_Audi'))
+
+    def test_rebalance_top(self):
+        os.makedirs(os.path.join(self.top, 'VRL', 'VRL2_VW11'))
+        os.makedirs(os.path.join(self.top, 'VRL2_VW11', '90_koniec'))
+        os.makedirs(os.path.join(self.top, 'archive', '2015'))
+        names = {'01_poczatek', '90_koniec'}
+        with mock.patch.object(self.m, 'lock_order',
+                               wraps=self.m.lock_order) as mlock:
+            result = self.m.rebalance_top(self.top, self.shard, names, 4)
+        mlock.assert_has_calls([
+            mock.call(self.top, 'ARL1_Audi'),
+            mock.call(self.top, os.path.join('ARL', 'ARL1_Audi'))])
+        self.assertEqual(result['moved'], 1)
+        self.assertEqual(result['skipped'], 1)
+        self.assertListEqual(result['errors'], [
+            (os.path.join(self.top, 'VRL2_VW11'),
+             "Order exists in its shard")])
+        self.assertListEqual(self.listdir(), ['ARL', 'VRL', 'VRL2_VW11',
+                                              'archive', 'notes.txt'])
+        self.assertListEqual(self.listdir('ARL'), [self.m.shard_marker,
+                                                   'ARL1_Audi'])
+        self.assertListEqual(self.listdir('ARL', 'ARL1_Audi'),
+                             ['01_poczatek'])
+
+
+def record_hook(paths):
+    """ A hook used by TestHooks. """
+    TestHooks.calls.append(list(paths))
+    if 'fail' in paths:
+        raise RuntimeError("Tracker unavailable")
+
+
+class TestHooks(unittest.TestCase):
+
+    calls = []
+
+    def setUp(self):
+        self.m = DirMaker.AppModel()
+        del TestHooks.calls[:]
+
+    def test_run_hooks_callable(self):
+        hooks = [('tracker', 'py:{}:record_hook'.format(__name__))]
+        paths = ['a', 'b', 'c', 'fail', 'e']
+        result = self.m.run_hooks(hooks, paths, 2, 3)
+        self.assertListEqual(sorted(self.calls), [['a', 'b'], ['c', 'fail'],
+                                                  ['e']])
+        self.assertEqual(result[0]['name'], 'tracker')
+        self.assertEqual(result[0]['batches'], 3)
+        self.assertListEqual(result[0]['errors'], [
+            "Tracker unavailable (2 orders from c)"])
+
+    def test_run_hooks_command(self):
+        args = [sys.executable, '-c',
+                'import sys; sys.exit(3 if "fail" in sys.argv else 0)']
+        if os.name == 'nt':
+            command = subprocess.list2cmdline(args)
+        else:
+            command = ' '.join(shlex.quote(a) for a in args)
+        hooks = [('ok', command),
+                 ('missing', 'py:{}:no_such_hook'.format(__name__)),
+                 ('empty', ' ')]
+        result = self.m.run_hooks(hooks, ['a', 'fail', 'b'], 2, 2)
+        self.assertEqual(result[0]['batches'], 2)
+        self.assertListEqual(result[0]['errors'], [
+            "Exit code 3 (2 orders from a)"])
+        self.assertEqual(result[1]['batches'], 0)
+        self.assertEqual(len(result[1]['errors']), 1)
+        self.assertListEqual(result[2]['errors'], ["Empty hook command"])
+
+    def test_load_hook_windows_quotes(self):
+        spec = '"C:\\Program Files\\Tracker\\x.exe" /q'
+        with mock.patch('DirMaker.os.name', 'nt'):
+            hook = self.m.load_hook(spec)
+        with mock.patch.object(self.m, 'run_command') as mrun:
+            hook(['D:\\Orders\\A1', 'D:\\New orders\\B2'])
+        mrun.assert_called_once_with(
+            '"C:\\Program Files\\Tracker\\x.exe" /q D:\\Orders\\A1 '
+            '"D:\\New orders\\B2"')
+
+    def test_run_hooks_import_error(self):
+        hooks = [('tracker', 'py:tracker:register_orders'),
+                 ('ok', 'py:{}:record_hook'.format(__name__))]
+        with mock.patch('importlib.import_module',
+                        side_effect=[RuntimeError("No tracker config"),
+                                     sys.modules[__name__]]):
+            result = self.m.run_hooks(hooks, ['a'], 2, 2)
+        self.assertListEqual(result[0]['errors'], ["No tracker config"])
+        self.assertEqual(result[1]['batches'], 1)
+        self.assertListEqual(self.calls, [['a']])
+
+    def test_run_command_timeout(self):
+        self.m.hook_timeout = 0.2
+        with self.assertRaises(TimeoutError):
+            self.m.run_command([sys.executable, '-c',
+                                'import time; time.sleep(5)'])
+
+
+class TestLockOrder(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.m = DirMaker.AppModel()
+        self.m.lock_timeout = 0.3
+        self.m.lock_poll = 0.01
+        self.lock = os.path.join(self.top, '.A1.lock')
+
+    def test_lock_path(self):
+        result = self.m.lock_path(self.top, os.path.join('A', 'A1'))
+        self.assertEqual(result, os.path.join(self.top, 'A', '.A1.lock'))
+
+    def test_lock_order(self):
+        with self.m.lock_order(self.top, 'A1'):
+            self.assertListEqual(self.listdir(), ['.A1.lock'])
+            with open(self.lock) as f:
+                self.assertTrue(f.read().endswith(':{}'.format(os.getpid())))
+            with self.m.lock_order(self.top, 'B2'):
+                self.assertListEqual(self.listdir(), ['.A1.lock',
+                                                      '.B2.lock'])
+        self.assertListEqual(self.listdir(), [])
+
+    def test_lock_order_timeout(self):
+        with self.m.lock_order(self.top, 'A1'):
+            with self.assertRaises(TimeoutError):
+                with self.m.lock_order(self.top, 'A1'):
+                    pass
+            self.assertTrue(os.path.isfile(self.lock))
+
+    def test_lock_order_wait(self):
+        """ A lock released by another run is taken over. """
+        order = []
+
+        def other_run():
+            with self.m.lock_order(self.top, 'A1'):
+                started.set()
+                time.sleep(0.05)
+                order.append('other')
+
+        started = threading.Event()
+        t = threading.Thread(target=other_run)
+        t.start()
+        started.wait(1)
+        with self.m.lock_order(self.top, 'A1'):
+            order.append('this')
+        t.join()
+        self.assertListEqual(order, ['other', 'this'])
+
+    def test_break_stale_lock_fresh(self):
+        """ A lock taken by another run after the stale lock was seen is
+            kept. """
+        with open(self.lock, 'w') as f:
+            f.write('other:1')
+        old = time.time() - self.m.lock_stale - 1
+        getmtime = os.path.getmtime
+        with mock.patch('DirMaker.os.path.getmtime',
+                        side_effect=[old, getmtime(self.lock)]):
+            self.m.break_stale_lock(self.lock)
+        self.assertListEqual(self.listdir(), ['.A1.lock'])
+        with open(self.lock) as f:
+            self.assertEqual(f.read(), 'other:1')
+
+    def test_break_stale_lock_retaken(self):
+        """ A lock taken while a fresh lock is being linked back is never
+            overwritten. """
+        with open(self.lock, 'w') as f:
+            f.write('other:1')
+        old = time.time() - self.m.lock_stale - 1
+        fresh = os.path.getmtime(self.lock)
+        rename = os.rename
+
+        def retake(src, dst):
+            rename(src, dst)
+            with open(self.lock, 'w') as f:
+                f.write('other:2')
+
+        with mock.patch('DirMaker.os.path.getmtime',
+                        side_effect=[old, fresh]), \
+                mock.patch('DirMaker.os.rename', side_effect=retake):
+            self.m.break_stale_lock(self.lock)
+        self.assertListEqual(self.listdir(), ['.A1.lock'])
+        with open(self.lock) as f:
+            self.assertEqual(f.read(), 'other:2')
+
+    def test_lock_order_stale(self):
+        open(self.lock, 'w').close()
+        old = time.time() - self.m.lock_stale - 1
+        os.utime(self.lock, (old, old))
+        with self.m.lock_order(self.top, 'A1'):
+            self.assertListEqual(self.listdir(), ['.A1.lock'])
+        self.assertListEqual(self.listdir(), [])
+
+
+class TestParsePreview(unittest.TestCase):
+
+    def setUp(self):
+        self.p = DirMaker.ParsePreview()
+
+    def summary(self):
+        return self.p.parsed, self.p.ignored, self.p.duplicates
+
+    def test_replace(self):
+        self.p.replace(0, 1, ['A1 - x', '', ' -- ', 'B2', 'a1', 'A1'])
+        self.assertTupleEqual(self.summary(), (4, 1, 2))
+        self.assertListEqual(self.p.lines, ['A1', '', None, 'B2', 'a1',
+                                            'A1'])
+        # Line 5 is deleted.
+        self.p.replace(3, 5, ['B2'])
+        self.assertTupleEqual(self.summary(), (3, 1, 1))
+        # Line 3 is edited and split into two lines.
+        self.p.replace(2, 3, [' -- C3', ' D4'])
+        self.assertTupleEqual(self.summary(), (5, 0, 1))
+        self.assertListEqual(self.p.lines, ['A1', '', 'C3', 'D4', 'B2',
+                                            'A1'])
+        # Everything is deleted.
+        self.p.replace(0, 6, [''])
+        self.assertTupleEqual(self.summary(), (0, 0, 0))
+        self.assertListEqual(self.p.lines, [''])
+        self.assertFalse(self.p.counts)
+
+    def test_replace_only_edited(self):
+        self.p.replace(0, 1, ['A{}'.format(i) for i in range(1000)])
+        with mock.patch.object(self.p, 'parse_line',
+                               wraps=self.p.parse_line) as mparse:
+            self.p.replace(500, 501, ['A1'])
+            mparse.assert_called_once_with('A1')
+        self.assertTupleEqual(self.summary(), (1000, 0, 1))
+
+
+class TestInputRange(unittest.TestCase):
+
+    # Five lines of text, each three characters long.
+    total = 5
+
+    def line(self, index):
+        index = index.replace('end', '6.0')
+        line, char = index.split('.', 1)
+        if char == '3+1c':
+            line = int(line) + 1
+        return min(int(line), self.total)
+
+    def input_range(self, cmd, *args):
+        return DirMaker.AppView.input_range(cmd, args, self.line, self.total)
+
+    def test_insert(self):
+        self.assertEqual(self.input_range('insert', '2.1', 'x\ny'), (2, 2))
+        self.assertEqual(self.input_range('insert', 'end', 'x'), (5, 5))
+
+    def test_delete(self):
+        self.assertEqual(self.input_range('delete', '2.1'), (2, 2))
+        # Deleting the newline at the end of a line joins the next one.
+        self.assertEqual(self.input_range('delete', '3.3'), (3, 4))
+        self.assertEqual(self.input_range('delete', '2.0', '4.1'), (2, 4))
+        self.assertEqual(self.input_range('delete', '1.0', 'end'), (1, 5))
+        self.assertEqual(self.input_range('delete', '4.0', '4.1', '1.0',
+                                          '1.1'), (1, 5))
+
+    def test_replace(self):
+        self.assertEqual(self.input_range('replace', '2.0', '3.1', 'x'),
+                         (2, 3))
+
+    def test_reversed(self):
+        self.assertIsNone(self.input_range('delete', '4.0', '2.0'))
+        self.assertIsNone(self.input_range('replace', '4.0', '2.0', 'x'))
+
+    def test_proxy_skips_reversed(self):
+        view = mock.Mock(input_range=DirMaker.AppView.input_range,
+                         scrolltext_cmd='orig')
+        view.input_line.side_effect = lambda index, last: min(
+            self.line(index), last)
+        DirMaker.AppView.input_proxy(view, 'delete', '4.0', '2.0')
+        view.root.tk.call.assert_called_once_with(
+            ('orig', 'delete', '4.0', '2.0'))
+        view.controller.edit_input.assert_not_called()
+        view.schedule_preview.assert_not_called()
+        DirMaker.AppView.input_proxy(view, 'delete', '2.0', '4.1')
+        view.controller.edit_input.assert_called_once_with(
+            1, 4, mock.ANY)
+        view.schedule_preview.assert_called_once_with()
+
 
 class TestValidateData(unittest.TestCase):
     """ Class doc """
@@ -276,7 +988,7 @@ class TestRun(unittest.TestCase):
         self.c.init_model()
         self.c.init_view = mock.Mock()
         self.c.view = mock.Mock()
-        self.c.config = configparser.ConfigParser()
+        self.c.config = DirMaker.SettingsStore('test.ini')
         self.controller_patch = mock.patch.multiple('DirMaker.AppController',
                                                     get_top=mock.DEFAULT,
                                                     get_make_02=mock.DEFAULT,
@@ -309,70 +1021,26 @@ class TestRun(unittest.TestCase):
         result = self.c.create_order_dict()
         self.assertDictEqual(result, self.order)
 
-    def test_write_config_0(self):
-        """ Scenario 0:  """
-        self.c.configfile = io.StringIO()
-        self.c.appdir = os.path.normpath('/test')
-        key, val = ('top', '/home')
-        calls = [mock.call().write("[user_options]\n"),
-                 mock.call().write("top = /home\n"),
-                 mock.call().write("\n")]
-        m = mock.mock_open()
-        # DirMaker.os.path.dirname = mock.Mock()
-        # DirMaker.os.path.exists = mock.Mock(return_value=True)
-        DirMaker.os.path.isdir = mock.Mock(return_value=True)
-        DirMaker.os.makedirs = mock.Mock()
-        if sys.version_info < (3, 5):
-            mopen = mock.patch('builtins.open', m, create=True)
-        else:
-            mopen = mock.patch('DirMaker.open', m)
-        mopen.start()
-        # if sys.version_info < (3, 5):
-        #     print("Py 3.4")
-        #     with mock.patch('builtins.open',  m, create=True) as mopen:
-        #         self.c.write_config(key, val)
-        #         m.assert_called_once_with(self.c.configfile, 'w+')
-        #         assert m().write.call_count == 3
-        #         m.assert_has_calls(calls)
-        #         assert not DirMaker.os.makedirs.called
-        # else:
-        #     print("Py 3.5")
-        #     with mock.patch('DirMaker.open', m):
-        #         self.c.write_config(key, val)
-        #         m.assert_called_once_with(self.c.configfile, 'w+')
-        #         assert m().write.call_count == 3
-        #         m.assert_has_calls(calls)
-        #         assert not DirMaker.os.makedirs.called
-        self.c.write_config(key, val)
-        m.assert_called_once_with(self.c.configfile, 'w+')
-        assert m().write.call_count == 3
-        m.assert_has_calls(calls)
-        assert not DirMaker.os.makedirs.called
-        mopen.stop()
-
-    def test_write_config_1(self):
-        """ Scenario 1:  """
-        self.c.configfile = io.StringIO()
-        self.c.appdir = os.path.normpath('/test')
-        key, val = ('top', '/home')
-        calls = [mock.call().write("[user_options]\n"),
-                 mock.call().write("top = /home\n"),
-                 mock.call().write("\n")]
-        m = mock.mock_open()
-        DirMaker.os.path.isdir = mock.Mock(return_value=False)
-        DirMaker.os.makedirs = mock.Mock(return_value=None)
-        if sys.version_info < (3, 5):
-            mopen = mock.patch('builtins.open', m, create=True)
-        else:
-            mopen = mock.patch('DirMaker.open', m)
-        mopen.start()
-        self.c.write_config(key, val)
-        m.assert_called_once_with(self.c.configfile, 'w+')
-        assert m().write.call_count == 3
-        m.assert_has_calls(calls)
-        DirMaker.os.makedirs.assert_called_once_with(os.path.normpath('/test'),
-                                                     exist_ok=True)
-        mopen.stop()
+    def test_write_config(self):
+        self.c.logger = mock.Mock()
+        self.c.config = mock.Mock()
+        self.c.config.recent_tops.return_value = ['/home']
+        self.c.config.broken = False
+        self.c.write_config(self.order)
+        self.c.config.remember_top.assert_called_once_with(
+            '/home', {'brand': 'Audi', 'make_02': 'no', 'make_pdf': 'yes'})
+        assert self.c.config.save.call_count == 1
+        self.c.view.set_recent_tops.assert_called_once_with(['/home'])
+        self.c.config.save.side_effect = OSError("Disk full")
+        self.c.write_config(self.order)
+        self.c.logger.warning.assert_called_once_with(
+            "Configuration file not saved: Disk full")
+        self.c.config.save.side_effect = None
+        self.c.config.broken = True
+        self.c.write_config(self.order)
+        self.c.logger.warning.assert_called_with(
+            "Configuration file not saved: "
+            "Configuration file parsing error.")
 
     def test_run_0(self):
         """ Scenario 0: controller.validate_data returns False"""
@@ -388,28 +1056,140 @@ class TestRun(unittest.TestCase):
         assert not self.c.create_dirs.called
         assert not self.c.view.set_statusmsg.called
 
+    def test_run_import(self):
+        self.c.create_order_dict = mock.Mock(return_value=self.order)
+        self.c.validate_data = mock.Mock(return_value=True)
+        self.c.execute = mock.Mock()
+        self.c.run_import('/home/export.csv')
+        order = dict(self.order, csv='/home/export.csv')
+        self.c.validate_data.assert_called_once_with(order)
+        self.c.execute.assert_called_once_with(order)
+
+    def test_execute_import_error(self):
+        self.c.logger = mock.Mock()
+        self.c.write_config = mock.Mock()
+        self.c.create_dirs = mock.Mock()
+        self.c.create_plan = mock.Mock(
+            side_effect=ValueError("Column not found: ID"))
+        self.c.execute(self.order)
+        msg = "Import failed: Column not found: ID"
+        self.c.view.showerr.assert_called_once_with(msg)
+        assert not self.c.create_dirs.called
+
+    def test_validate_plan(self):
+        self.c.logger = mock.Mock()
+        self.c.max_errors = 2
+        self.c.model.validate_plan = mock.Mock(return_value=[])
+        self.assertTrue(self.c.validate_plan(None))
+        assert not self.c.view.showerr.called
+        self.c.model.validate_plan.return_value = [
+            ('duplicate', 'A1'),
+            ('collision', 'a1', 'A1'),
+            ('length', '/home/B2'),
+            ('reserved', 'CON')]
+        self.assertFalse(self.c.validate_plan(None))
+        assert self.c.logger.error.call_count == 4
+        self.c.logger.error.assert_called_with("Reserved name: CON")
+        self.c.view.showerr.assert_called_once_with(
+            "Duplicate order: A1\na1 collides with A1\n"
+            "... and 2 more problems.")
+
+    def test_upgrade(self):
+        self.c.logger = mock.Mock()
+        self.cp['get_top'].return_value = os.pathsep.join(('/a', '/b'))
+        self.c.model.verify_top = mock.Mock(return_value=True)
+        self.c.model.upgrade_top = mock.Mock(side_effect=[
+            {'top': '/a', 'upgraded': 2, 'skipped': 5,
+             'errors': [('/a/C3', 'Permission denied')]},
+            OSError(5, 'Input/output error')])
+        self.c.upgrade()
+        self.c.model.upgrade_top.assert_called_with(
+            '/b', self.c.create_upgrade_groups(), self.c.max_workers)
+        self.c.view.showerr.assert_called_once_with(
+            "Cannot upgrade /a/C3: Permission denied\n"
+            "Cannot upgrade /b: Input/output error")
+        self.c.view.set_statusmsg.assert_called_once_with(
+            "Done! /a: 2 upgraded, 5 up to date, 1 failed; /b: failed")
+
+    def test_rebalance(self):
+        self.c.logger = mock.Mock()
+        self.cp['get_top'].return_value = '/a'
+        self.c.model.verify_top = mock.Mock(return_value=True)
+        self.c.model.rebalance_top = mock.Mock(return_value={
+            'top': '/a', 'moved': 3, 'skipped': 1, 'errors': []})
+        self.c.rebalance()
+        self.c.view.showerr.assert_called_once_with(
+            self.c.configerr['noshard'])
+        self.c.config.config.read_dict({'layout': {'shard': 'brand'}})
+        self.c.rebalance()
+        self.c.model.rebalance_top.assert_called_once_with(
+            '/a', ('brand', 5), {'01_poczatek', 'rozliczenia_dla_klienta',
+                                 '90_koniec', '02_przygotowanie'},
+            self.c.max_workers)
+        self.c.view.set_statusmsg.assert_called_once_with(
+            "Done! /a: 3 moved, 1 not orders, 0 failed")
+
+    def test_upgrade_not_confirmed(self):
+        self.cp['get_top'].return_value = '/a'
+        self.c.model.verify_top = mock.Mock(return_value=True)
+        self.c.model.upgrade_top = mock.Mock()
+        self.c.view.confirm.return_value = False
+        self.c.upgrade()
+        assert not self.c.model.upgrade_top.called
+
+    def test_preview(self):
+        self.c.edit_input(0, 1, ['A1', 'x y', '-', 'A1'])
+        self.c.show_preview()
+        self.c.view.set_previewmsg.assert_called_once_with(
+            "Orders: 3, ignored lines: 1, duplicates: 1")
+
+    def test_get_csv_options(self):
+        self.c.config.config.read_dict({'csv_import': {'id_column': 'Nr',
+                                                'header': 'no'},
+                                 'csv_brands': {'cupra': 'Seat'}})
+        result = self.c.get_csv_options()
+        self.assertEqual(result['id_column'], 'Nr')
+        self.assertEqual(result['delimiter'], ',')
+        self.assertFalse(result['header'])
+        self.assertEqual(result['brands']['cupra'], 'Seat')
+        self.assertEqual(result['brands']['audi'], 'Audi')
+
     def test_run_1(self):
         """ Scenario 1: controller.validate_data returns True"""
         self.c.create_order_dict = mock.Mock(return_value=self.order)
         self.c.write_config = mock.Mock()
         self.c.create_dirs = mock.Mock()
+        self.c.create_plan = mock.Mock()
+        self.c.validate_plan = mock.Mock(return_value=True)
+        self.c.run_hooks = mock.Mock(return_value=[])
+        self.c.summarize = mock.Mock(return_value="Done! /home: 2")
         self.c.view.set_statusmsg = mock.Mock()
         self.c.validate_data = mock.Mock(return_value=True)
         self.c.run()
         assert self.c.create_order_dict.call_count == 1
         assert self.c.write_config.call_count == 1
-        assert self.c.create_dirs.call_count == 1
-        self.c.view.set_statusmsg.assert_called_once_with("Done!")
+        self.c.create_plan.assert_called_once_with(self.order)
+        self.c.create_dirs.assert_called_once_with(
+            self.c.create_plan.return_value)
+        self.c.run_hooks.assert_called_once_with(
+            self.c.create_plan.return_value,
+            self.c.create_dirs.return_value)
+        self.c.summarize.assert_called_once_with(
+            self.c.create_plan.return_value,
+            self.c.create_dirs.return_value,
+            [])
+        self.c.view.set_statusmsg.assert_called_once_with("Done! /home: 2")
 
 
 class TestConfigAndLog(unittest.TestCase):
 
     def setUp(self):
         self.c = DirMaker.AppController()
-        self.c.config = configparser.ConfigParser()
+        self.c.config = DirMaker.SettingsStore('test.ini')
         self.c.configfile = 'test.ini'
         self.c.logger = mock.Mock()
         self.c.set_top = mock.Mock()
+        self.c.view = mock.Mock()
 
     def test_create_appdir(self):
         DirMaker.os.makedirs = mock.Mock()
@@ -425,55 +1205,59 @@ class TestConfigAndLog(unittest.TestCase):
         out = os.path.normpath('/home/user/.woffice/.testapp/.settings.ini')
         self.c.init_config()
         self.assertEqual(self.c.configfile, out)
+        self.assertEqual(self.c.config.path, out)
         assert self.c.load_config.called
 
     def test_load_config_0(self):
         """ Scenario 0:
-            - the config file doesn't exists - os.path.isfile: False,
-            - ConfigParser raises KeyError,
+            - the config file doesn't exists,
             - set_top loads default value,
             - logger writes two messages to the log file.
         """
-        # DirMaker.os.path.exists = mock.Mock(return_value=False)
-        DirMaker.os.path.isfile = mock.Mock(return_value=False)
-        self.c.config.read = mock.Mock()
-        with self.assertRaises(KeyError):
-            DirMaker.configparser.ConfigParser()['user_options']
+        self.c.config.exists = mock.Mock(return_value=False)
+        self.c.config.load = mock.Mock()
         self.c.load_config()
         calls = [mock.call.warning(self.c.configerr['nofile']),
                  mock.call.warning(self.c.configerr['keyerr'])]
-        assert not self.c.config.read.called
+        assert not self.c.config.load.called
         self.c.logger.assert_has_calls(calls)
         self.c.set_top.assert_called_once_with(self.c.userdir)
+        self.c.view.set_recent_tops.assert_called_once_with([])
+        assert not self.c.view.set_brand.called
 
     def test_load_config_1(self):
         """ Scenario 1:
-            - the config file exists - os.path.isfile: True
-            - the config file is read successfully,
+            - the config file exists and is read successfully,
             - set_top loads value from the config file,
+            - options remembered for the top are restored,
             - logger doesn't write any messages to the log file.
         """
-        self.c.config.read_dict({'user_options': {'top': '/home/test'}})
-        # DirMaker.os.path.exists = mock.Mock(return_value=True)
-        DirMaker.os.path.isfile = mock.Mock(return_value=True)
-        self.c.config.read = mock.Mock()
+        self.c.config.config.read_dict({
+            'user_options': {'top': '/home/test'},
+            'recent_tops': {'0': '/home/test', '1': '/mnt'},
+            'top:/home/test': {'brand': 'Seat', 'make_02': 'yes'}})
+        self.c.config.exists = mock.Mock(return_value=True)
+        self.c.config.load = mock.Mock()
         self.c.load_config()
-        assert self.c.config.read.call_count == 1
+        assert self.c.config.load.call_count == 1
         assert not self.c.logger.warning.called
         self.c.set_top.assert_called_once_with('/home/test')
+        self.c.view.set_recent_tops.assert_called_once_with(['/home/test',
+                                                             '/mnt'])
+        self.c.view.set_brand.assert_called_once_with('Seat')
+        self.c.view.set_make_02.assert_called_once_with(True)
+        assert not self.c.view.set_make_pdf.called
 
     def test_load_config_2(self):
         """ Scenario 2:
-            - the config file exists - os.path.isfile: True,
+            - the config file exists,
             - parsing config file failed,
             - set_top loads default value,
             - logger writes two messages to the log file.
         """
-        self.c.config.read = mock.Mock(side_effect=configparser.ParsingError('None'))
-        DirMaker.os.path.isfile = mock.Mock(return_value=True)
-        with self.assertRaises(configparser.ParsingError):
-            self.c.config.read()
-        self.c.config.read_dict({'': {'': ''}})
+        self.c.config.exists = mock.Mock(return_value=True)
+        self.c.config.load = mock.Mock(
+            side_effect=configparser.ParsingError('None'))
         self.c.load_config()
         self.c.set_top.assert_called_once_with(self.c.userdir)
         calls = [mock.call.warning(self.c.configerr['parse']),
@@ -482,5 +1266,89 @@ class TestConfigAndLog(unittest.TestCase):
         self.c.logger.assert_has_calls(calls)
 
 
+class TestSettingsStore(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.top, 'app', '.settings.ini')
+        self.store = DirMaker.SettingsStore(self.path)
+        self.options = {'brand': 'Audi', 'make_02': 'yes'}
+
+    def test_save_only_changes(self):
+        self.assertFalse(self.store.save())
+        self.store.remember_top('/home', self.options)
+        self.assertTrue(self.store.save())
+        self.assertListEqual(self.listdir('app'), ['.settings.ini'])
+        self.store.remember_top('/home', self.options)
+        self.assertFalse(self.store.save())
+        self.store.remember_top('/home', {'brand': 'Seat'})
+        self.assertTrue(self.store.save())
+        other = DirMaker.SettingsStore(self.path)
+        self.assertTrue(other.load())
+        self.assertEqual(other.get('user_options', 'top'), '/home')
+        self.assertDictEqual(other.top_options('/home'),
+                             {'brand': 'Seat', 'make_02': 'yes'})
+
+    def test_save_atomic(self):
+        self.store.remember_top('/home', self.options)
+        self.store.save()
+        self.store.remember_top('/mnt', self.options)
+        with mock.patch('DirMaker.os.replace',
+                        side_effect=OSError("Access denied")):
+            with self.assertRaises(OSError):
+                self.store.save()
+        self.assertListEqual(self.listdir('app'), ['.settings.ini'])
+        other = DirMaker.SettingsStore(self.path)
+        other.load()
+        self.assertListEqual(other.recent_tops(), ['/home'])
+
+    def test_load_cached(self):
+        self.assertFalse(self.store.load())
+        self.store.remember_top('/home', self.options)
+        self.store.save()
+        self.assertFalse(self.store.load())
+        other = DirMaker.SettingsStore(self.path)
+        other.load()
+        with mock.patch('DirMaker.configparser.ConfigParser') as mparser:
+            self.assertFalse(other.load())
+            assert not mparser.called
+        mtime = os.path.getmtime(self.path) + 10
+        os.utime(self.path, (mtime, mtime))
+        self.assertTrue(other.load())
+
+    def test_broken_file_not_overwritten(self):
+        self.store.remember_top('/home', self.options)
+        self.store.save()
+        data = '[layout]\nshard = prefix\nbroken line\n'
+        with open(self.path, 'w') as f:
+            f.write(data)
+        mtime = os.path.getmtime(self.path) + 10
+        os.utime(self.path, (mtime, mtime))
+        with self.assertRaises(configparser.Error):
+            self.store.load()
+        self.assertTrue(self.store.broken)
+        self.store.remember_top('/mnt', self.options)
+        self.assertFalse(self.store.save())
+        with open(self.path) as f:
+            self.assertEqual(f.read(), data)
+        with self.assertRaises(configparser.Error):
+            self.store.load()
+        with open(self.path, 'w') as f:
+            f.write('[layout]\nshard = prefix\n')
+        os.utime(self.path, (mtime + 10, mtime + 10))
+        self.assertTrue(self.store.load())
+        self.assertFalse(self.store.broken)
+        self.assertEqual(self.store.get('layout', 'shard'), 'prefix')
+
+    def test_remember_top(self):
+        self.store.max_recent = 3
+        for top in ('/a', '/b', '/c', '/b', '/d'):
+            self.store.remember_top(top, {'brand': top})
+        self.assertListEqual(self.store.recent_tops(), ['/d', '/b', '/c'])
+        self.assertDictEqual(self.store.top_options('/a'), {})
+        self.assertDictEqual(self.store.top_options('/c'), {'brand': '/c'})
+        self.assertEqual(self.store.get('user_options', 'top'), '/d')
+
+
 if __name__ == '__main__':
     unittest.main()